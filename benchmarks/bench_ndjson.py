@@ -0,0 +1,104 @@
+# benchmarks/bench_ndjson.py
+# Микро-бенчмарк разбора стрима Ollama: сколько стоит разбор одного токена.
+# Сравнивает NDJSONDecoder (куски произвольной длины) со старым способом
+# "строка -> decode -> strip -> json.loads".
+#
+# Запуск из корня репозитория:
+#     python -m benchmarks.bench_ndjson [--tokens 20000] [--repeat 5]
+
+import argparse
+import json
+import random
+import time
+
+from services.ndjson import JSON_BACKEND, NDJSONDecoder
+
+
+def make_stream(tokens: int) -> bytes:
+    """Стрим, похожий на ответ /api/chat: по объекту на токен и финальный done."""
+    words = ["Привет", " мир", ",", " как", " дела", "?", " Это", " тест", "\n"]
+    lines = []
+    for i in range(tokens):
+        lines.append(json.dumps({
+            "model": "llama3.1:8b",
+            "created_at": "2024-01-01T00:00:00.000000Z",
+            "message": {"role": "assistant", "content": words[i % len(words)]},
+            "done": False,
+        }, ensure_ascii=False))
+    lines.append(json.dumps({
+        "model": "llama3.1:8b",
+        "created_at": "2024-01-01T00:00:00.000000Z",
+        "message": {"role": "assistant", "content": ""},
+        "done": True,
+        "total_duration": 1, "load_duration": 1,
+        "prompt_eval_count": 10, "prompt_eval_duration": 1,
+        "eval_count": tokens, "eval_duration": 1,
+    }))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def split_chunks(data: bytes, rng: random.Random) -> list:
+    """Режет стрим на куски случайной длины, как это делает сеть."""
+    chunks = []
+    i = 0
+    while i < len(data):
+        n = rng.randint(16, 4096)
+        chunks.append(data[i:i + n])
+        i += n
+    return chunks
+
+
+def bench_decoder(chunks: list) -> int:
+    decoder = NDJSONDecoder()
+    count = 0
+    for c in chunks:
+        count += len(decoder.feed(c))
+    count += len(decoder.close())
+    return count
+
+
+def bench_naive(lines: list) -> int:
+    count = 0
+    for raw in lines:
+        decoded = raw.decode(errors="ignore").strip()
+        if not decoded:
+            continue
+        data = json.loads(decoded)
+        if data["message"].get("content") or data.get("done"):
+            count += 1
+    return count
+
+
+def measure(fn, arg, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    data = make_stream(args.tokens)
+    chunks = split_chunks(data, random.Random(0))
+    lines = data.splitlines(keepends=True)
+
+    t_dec = measure(bench_decoder, chunks, args.repeat)
+    t_naive = measure(bench_naive, lines, args.repeat)
+
+    print(json.dumps({
+        "json_backend": JSON_BACKEND,
+        "tokens": args.tokens,
+        "chunks": len(chunks),
+        "decoder_ns_per_token": round(t_dec / args.tokens * 1e9, 1),
+        "naive_ns_per_token": round(t_naive / args.tokens * 1e9, 1),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# benchmarks/e2e/fake_ollama.py
+# Локальная замена Ollama для бенчмарков: /api/tags и /api/chat со стримингом
+# с заданной скоростью, задержкой первого токена и внедрением ошибок.
+
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeOllama:
+    """
+    Параметры:
+    - tokens_per_sec: скорость выдачи токенов в одном стриме;
+    - first_token_delay: задержка перед первым токеном (prompt eval + загрузка), с;
+    - reply_tokens: сколько токенов в каждом ответе (меньше, если в запросе options.num_predict);
+    - error_rate: доля запросов, завершающихся ошибкой (HTTP 500 или обрыв стрима).
+    """
+
+    def __init__(
+        self,
+        models=("llama3.1:8b", "qwen2.5:7b"),
+        tokens_per_sec: float = 50.0,
+        first_token_delay: float = 0.3,
+        reply_tokens: int = 200,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.models = list(models)
+        self.tokens_per_sec = tokens_per_sec
+        self.first_token_delay = first_token_delay
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.tokens_sent = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.disconnects = 0
+        self._runner = None
+        self.url = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/tags", self.tags)
+        app.router.add_post("/api/chat", self.chat)
+        app.router.add_get("/api/ps", self.ps)
+        app.router.add_post("/api/generate", self.generate)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def tags(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": m} for m in self.models]})
+
+    async def ps(self, request: web.Request) -> web.Response:
+        # Считаем, что все модели уже загружены в память
+        return web.json_response({"models": [{"name": m} for m in self.models]})
+
+    async def generate(self, request: web.Request) -> web.Response:
+        # Используется ботом только для загрузки модели (без prompt)
+        body = await request.json()
+        return web.json_response({"model": body.get("model", ""), "response": "", "done": True})
+
+    def _line(self, model: str, content: str, done: bool = False, **extra) -> bytes:
+        obj = {
+            "model": model,
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+        }
+        obj.update(extra)
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode()
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "")
+        self.requests += 1
+        reply_tokens = self.reply_tokens
+        num_predict = (body.get("options") or {}).get("num_predict")
+        if num_predict and num_predict > 0:
+            reply_tokens = min(reply_tokens, num_predict)
+        if self.rng.random() < self.error_rate / 2:
+            self.errors += 1
+            return web.json_response({"error": "injected failure"}, status=500)
+
+        if not body.get("stream", True):
+            await asyncio.sleep(self.first_token_delay)
+            text = "слово " * reply_tokens
+            return web.json_response({
+                "model": model,
+                "message": {"role": "assistant", "content": text},
+                "done": True,
+            })
+
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await resp.prepare(request)
+            await asyncio.sleep(self.first_token_delay)
+            prompt_done = time.perf_counter()
+            # Обрыв посреди стрима — вторая половина внедряемых ошибок
+            break_at = (
+                self.rng.randrange(reply_tokens)
+                if self.rng.random() < self.error_rate / 2
+                else None
+            )
+            interval = 1.0 / self.tokens_per_sec
+            for i in range(reply_tokens):
+                if i == break_at:
+                    self.errors += 1
+                    await resp.write(self._line(model, "", error="injected stream failure"))
+                    return resp
+                await resp.write(self._line(model, "слово "))
+                self.tokens_sent += 1
+                await asyncio.sleep(interval)
+            finished = time.perf_counter()
+            await resp.write(self._line(
+                model, "", done=True,
+                total_duration=int((finished - started) * 1e9),
+                load_duration=0,
+                prompt_eval_count=len(body.get("messages", [])) * 20,
+                prompt_eval_duration=int((prompt_done - started) * 1e9),
+                eval_count=reply_tokens,
+                eval_duration=int((finished - prompt_done) * 1e9),
+            ))
+            await resp.write_eof()
+            return resp
+        except ConnectionResetError:
+            # Клиент закрыл соединение (генерацию остановили) — как и Ollama, прекращаем
+            self.disconnects += 1
+            return resp
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,92 @@
+# benchmarks/e2e/fake_telegram.py
+# Локальная замена Telegram Bot API: отвечает на sendMessage/editMessageText
+# и записывает время и размер каждой правки. Может отвечать 429 (Too Many Requests).
+
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    """
+    - edit_429_rate: доля правок, на которые вернуть 429 с retry_after;
+    - retry_after: сколько секунд просить подождать.
+    Для каждого сообщения (chat_id, message_id) записывается список
+    (время, текст) всех отправок и правок.
+    """
+
+    def __init__(self, edit_429_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.edit_429_rate = edit_429_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = defaultdict(int)
+        self.responses_429 = 0
+        self.bytes_sent = 0
+        # (chat_id, message_id) -> [(time.perf_counter(), text), ...]
+        self.messages = defaultdict(list)
+        self._next_id = defaultdict(lambda: 1000)
+        self._runner = None
+        self.url = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, chat_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Hubert"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        now = time.perf_counter()
+
+        if method == "sendMessage":
+            chat_id = int(data["chat_id"])
+            text = data.get("text", "")
+            self._next_id[chat_id] += 1
+            message_id = self._next_id[chat_id]
+            self.bytes_sent += len(text.encode())
+            self.messages[(chat_id, message_id)].append((now, text))
+            return web.json_response({"ok": True, "result": self._message(chat_id, message_id, text)})
+
+        if method == "editMessageText":
+            if self.rng.random() < self.edit_429_rate:
+                self.responses_429 += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+            chat_id = int(data["chat_id"])
+            message_id = int(data["message_id"])
+            text = data.get("text", "")
+            self.bytes_sent += len(text.encode())
+            self.messages[(chat_id, message_id)].append((now, text))
+            return web.json_response({"ok": True, "result": self._message(chat_id, message_id, text)})
+
+        # answerCallbackQuery, deleteMessage и прочее — просто "ok"
+        return web.json_response({"ok": True, "result": True})
@@ -0,0 +1,197 @@
+# benchmarks/e2e/run.py
+# Сквозной офлайн-бенчмарк бота: настоящий router из handlers/messages.py,
+# поддельные Ollama и Telegram Bot API на localhost и N симулированных пользователей.
+# Результат — один JSON-объект (stdout и/или файл), чтобы сравнивать релизы.
+#
+# Запуск из корня репозитория:
+#     python -m benchmarks.e2e.run --users 50 --messages 3 --tps 40 --output bench.json
+#
+# Фейковые серверы работают в том же event loop, что и бот: абсолютные числа
+# немного завышены, но сравнение между версиями остаётся честным.
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import resource
+import sys
+import time
+from collections import defaultdict
+
+import config
+from benchmarks.e2e.fake_ollama import FakeOllama
+from benchmarks.e2e.fake_telegram import FakeTelegram
+
+BOT_TOKEN = "123456:BENCHMARK"
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[idx]
+
+
+def summarize(values, scale: float = 1.0) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * scale, 3),
+        "p50": round(percentile(values, 50) * scale, 3),
+        "p99": round(percentile(values, 99) * scale, 3),
+        "max": round(max(values) * scale, 3),
+    }
+
+
+def is_status(text: str) -> bool:
+    # Служебные тексты заглушки (генерация, очередь и т.п.) начинаются с ⏳
+    return text.startswith("⏳")
+
+
+async def run(args) -> dict:
+    nodes = [
+        FakeOllama(
+            tokens_per_sec=args.tps,
+            first_token_delay=args.first_token_delay,
+            reply_tokens=args.reply_tokens,
+            error_rate=args.error_rate,
+            seed=i,
+        )
+        for i in range(args.nodes)
+    ]
+    telegram = FakeTelegram(edit_429_rate=args.edit_429_rate, retry_after=args.retry_after)
+    for node in nodes:
+        await node.start()
+    await telegram.start()
+
+    # Конфиг правится до импорта модулей бота: они читают значения при импорте
+    config.OLLAMA_URLS = [node.url for node in nodes]
+    config.STORAGE_BACKEND = "memory"
+    config.INPUT_DEBOUNCE_SECONDS = args.debounce
+    logging.basicConfig(level=logging.WARNING)
+
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    from handlers.messages import router
+    from services.ollama_client import client as ollama_client, pool as ollama_pool
+
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(telegram.url)),
+    )
+    dp = Dispatcher()
+    dp.include_router(router)
+    await ollama_client.start()
+    await ollama_pool.start()
+
+    update_ids = itertools.count(1)
+    # (chat_id) -> [(t_sent, t_done), ...]
+    replies = defaultdict(list)
+
+    async def simulate_user(user_id: int):
+        for i in range(args.messages):
+            update = {
+                "update_id": next(update_ids),
+                "message": {
+                    "message_id": i + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                    "text": f"Вопрос номер {i} от пользователя {user_id}",
+                },
+            }
+            t0 = time.perf_counter()
+            await dp.feed_raw_update(bot, update)
+            replies[user_id].append((t0, time.perf_counter()))
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(10_000 + u) for u in range(args.users)))
+    wall = time.perf_counter() - started
+
+    await ollama_pool.close()
+    await ollama_client.close()
+    await bot.session.close()
+    for node in nodes:
+        await node.stop()
+    await telegram.stop()
+
+    # Сообщения бота по чатам, в порядке появления
+    by_chat = defaultdict(list)
+    for (chat_id, message_id), records in telegram.messages.items():
+        by_chat[chat_id].append(records)
+    for chat in by_chat.values():
+        chat.sort(key=lambda r: r[0][0])
+
+    ttfvt, latency, edits = [], [], []
+    for chat_id, windows in replies.items():
+        for t0, t1 in windows:
+            # Все сообщения бота, созданные за время обработки этого запроса
+            reply_msgs = [r for r in by_chat[chat_id] if t0 <= r[0][0] <= t1]
+            latency.append(t1 - t0)
+            visible = [t for records in reply_msgs for t, text in records if text and not is_status(text)]
+            if visible:
+                ttfvt.append(min(visible) - t0)
+            edits.append(sum(len(records) - 1 for records in reply_msgs))
+
+    total = args.users * args.messages
+    # ru_maxrss в Linux — в килобайтах
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if sys.platform == "darwin":
+        peak_rss_mb /= 1024
+
+    return {
+        "params": vars(args),
+        "replies": total,
+        "wall_seconds": round(wall, 3),
+        "throughput_replies_per_sec": round(total / wall, 3) if wall else None,
+        "throughput_tokens_per_sec": round(sum(n.tokens_sent for n in nodes) / wall, 1) if wall else None,
+        "time_to_first_visible_token_ms": summarize(ttfvt, 1000),
+        "latency_ms": summarize(latency, 1000),
+        "edits_per_reply": summarize(edits),
+        "telegram_calls": dict(telegram.calls),
+        "telegram_429": telegram.responses_429,
+        "telegram_bytes_sent": telegram.bytes_sent,
+        "ollama_requests": sum(n.requests for n in nodes),
+        "ollama_errors": sum(n.errors for n in nodes),
+        "ollama_disconnects": sum(n.disconnects for n in nodes),
+        "ollama_peak_in_flight": [n.peak_in_flight for n in nodes],
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн e2e-бенчмарк бота")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=3, help="сообщений на пользователя")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза между сообщениями, с")
+    parser.add_argument("--nodes", type=int, default=1, help="сколько фейковых серверов Ollama")
+    parser.add_argument("--tps", type=float, default=50.0, help="токенов в секунду на стрим")
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--edit-429-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--debounce", type=float, default=0.0,
+        help="окно склейки сообщений, с (0 — каждое сообщение отвечается сразу)",
+    )
+    parser.add_argument("--output", help="куда дополнительно записать JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,10 @@ TOKEN = "8258095585:AAG89yiTWJIFfrSXglab2b-9hMi6liok2I8"
 
 # Базовый URL Ollama (локально обычно http://localhost:11434)
 OLLAMA_URL = "http://localhost:11434"
+# Все серверы Ollama, между которыми распределяются запросы
+OLLAMA_URLS = [OLLAMA_URL]
+# Раз в столько секунд проверяем узлы: живы ли, какие модели скачаны и загружены
+OLLAMA_HEALTH_INTERVAL_SECONDS = 10
 
 # Модель по умолчанию
 DEFAULT_MODEL = "llama3.1:8b"
@@ -13,3 +17,205 @@ DEFAULT_SYSTEM_PROMPT = "ТЫ - ТОЧНЫЙ И ПРАВИЛЬНЫЙ ПОМОЩ
 # Таймаут (в секундах) для HTTP-запросов к Ollama — при необходимости увеличь
 HTTP_TIMEOUT_SECONDS = 20
 
+
+# Пул HTTP-соединений к Ollama (один долгоживущий клиент на весь процесс)
+# Максимум одновременных соединений всего и на один хост
+OLLAMA_POOL_LIMIT = 100
+OLLAMA_POOL_LIMIT_PER_HOST = 32
+# Сколько секунд держать простаивающее keep-alive соединение открытым
+OLLAMA_KEEPALIVE_SECONDS = 60
+# Таймауты (в секундах): установка соединения и ожидание очередного куска ответа
+OLLAMA_CONNECT_TIMEOUT = 10
+OLLAMA_READ_TIMEOUT = 60
+# Сколько ждать ответа, пока модель ещё не загружена на узле (и при прогреве):
+# холодная загрузка большой модели легко занимает больше OLLAMA_READ_TIMEOUT.
+# Таймаут чтения не считается отказом узла — на другой узел переключаемся
+# только при ошибках соединения
+OLLAMA_LOAD_TIMEOUT = 600
+
+# Кэш списка моделей: сколько секунд список считается свежим и сколько ещё
+# секунд после этого можно отдавать устаревший список, обновляя его в фоне
+MODEL_CATALOG_TTL_SECONDS = 30
+MODEL_CATALOG_STALE_SECONDS = 300
+
+# Распознавание голосовых (faster-whisper)
+# Размер модели: "base", "small", "medium"... — "small" хорошо подходит для русского
+WHISPER_MODEL_SIZE = "small"
+WHISPER_DEVICE = "cpu"
+# Тип вычислений: "int8" заметно быстрее и легче на CPU, "float16" — для GPU
+WHISPER_COMPUTE_TYPE = "int8"
+# Потоков CTranslate2 на одну модель (0 — автоматически)
+WHISPER_CPU_THREADS = 0
+# Сколько моделей держать загруженными (столько голосовых распознаётся параллельно)
+WHISPER_WORKERS = 1
+# Сколько голосовых может ждать в очереди сверх работающих; остальные отклоняются
+WHISPER_QUEUE_SIZE = 8
+WHISPER_LANGUAGE = "ru"
+# Голосовые длиннее этого (в секундах) декодируются и распознаются кусками,
+# чтобы не держать в памяти всю волну целиком
+WHISPER_LONG_AUDIO_SECONDS = 120
+# Длина одного куска для длинных голосовых, секунд
+WHISPER_CHUNK_SECONDS = 30
+
+# Стриминг ответа в Telegram
+# Не чаще одной правки сообщения раз в столько секунд (на одно сообщение)
+LIVE_EDIT_INTERVAL_SECONDS = 1.0
+# Общий лимит правок на весь бот: в секунду и максимум подряд
+TELEGRAM_EDITS_PER_SECOND = 25
+TELEGRAM_EDITS_BURST = 30
+
+# Планировщик генераций (очередь запросов к Ollama)
+# Максимум одновременных генераций всего
+GEN_MAX_CONCURRENT = 4
+# Максимум одновременных генераций на модель; "*" — для всех остальных моделей
+GEN_MAX_PER_MODEL = {"*": 2}
+# Сколько запросов может ждать в очереди; остальные сразу отклоняются
+GEN_QUEUE_SIZE = 100
+# Сколько секунд запрос может ждать в очереди, прежде чем будет отменён
+GEN_QUEUE_TIMEOUT_SECONDS = 120
+
+# История диалога
+# Размер контекста моделей в токенах; "*" — для всех остальных моделей.
+# Передаётся в Ollama как num_ctx в каждом запросе к модели (и при её загрузке)
+MODEL_CONTEXT_TOKENS = {"*": 4096}
+# Какую долю контекста можно занять system prompt'ом и историей (остальное — под ответ)
+HISTORY_BUDGET_RATIO = 0.6
+# Сколько символов в среднем приходится на один токен (для русского текста ~3)
+HISTORY_CHARS_PER_TOKEN = 3
+# Сколько последних реплик всегда остаются дословно при сжатии истории
+HISTORY_KEEP_RECENT = 6
+
+# Хранилище настроек пользователей: "sqlite" (сохраняется между перезапусками)
+# или "memory" (только в памяти процесса)
+STORAGE_BACKEND = "sqlite"
+STORAGE_SQLITE_PATH = "hubert.db"
+# Сколько активных пользователей держать в памяти
+STORAGE_HOT_USERS = 10000
+# Сколько памяти (примерно) могут занимать сессии пользователей; сверх этого
+# давно неактивные и уже сохранённые сессии выгружаются (подгрузятся из базы)
+STORAGE_MEMORY_BUDGET_MB = 256
+# Раз в столько секунд изменения пишутся в базу одной транзакцией
+STORAGE_FLUSH_INTERVAL_SECONDS = 2
+
+# Уровень логирования: "DEBUG" — подробные логи каждого события стрима (медленно),
+# "INFO" — для обычной работы
+LOG_LEVEL = "INFO"
+
+# Кэш ответов для одинаковых запросов (модель + system prompt + история + запрос).
+# Выключен по умолчанию: одинаковые вопросы будут получать одинаковые ответы
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+# Ограничение памяти под тексты ответов, в байтах
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+RESPONSE_CACHE_TTL_SECONDS = 3600
+# По сколько символов проигрывать ответ из кэша через стриминг
+RESPONSE_CACHE_REPLAY_CHUNK = 200
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101
+
+# Режим получения обновлений: "polling" (long polling, один процесс)
+# или "webhook" (HTTP-сервер, можно несколько процессов-воркеров)
+RUN_MODE = "polling"
+# Публичный адрес, на который Telegram будет слать обновления (https://...)
+WEBHOOK_URL = "https://example.com"
+WEBHOOK_PATH = "/webhook"
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (пустая строка — без проверки)
+WEBHOOK_SECRET = ""
+# Где слушать входящие запросы (обычно за reverse proxy с TLS)
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+# Сколько процессов обрабатывают обновления. Каждый пользователь всегда попадает
+# в один и тот же воркер, поэтому его настройки и история не расходятся.
+# Каждый воркер держит свои модели Whisper и свой порт метрик (METRICS_PORT + номер).
+# Очередь генераций у каждого воркера своя, а Ollama общая: GEN_MAX_CONCURRENT,
+# GEN_MAX_PER_MODEL и GEN_QUEUE_SIZE делятся между воркерами поровну (но не меньше
+# 1 на воркер — при воркеров больше лимита Ollama получит больше запросов).
+# Регулятор нагрузки каждого воркера видит только свою долю нагрузки.
+# Закреплённые модели прогревает только воркер 0.
+WEBHOOK_WORKERS = 1
+
+# Удержание моделей в памяти Ollama
+# Сколько держать модель загруженной после последнего запроса (формат Ollama: "30m", "1h")
+OLLAMA_KEEP_ALIVE = "30m"
+# Модели, которые держим загруженными всегда (keep_alive = -1) и прогреваем при старте
+OLLAMA_PINNED_MODELS = [DEFAULT_MODEL]
+# Раз в столько секунд проверяем, что закреплённые модели всё ещё в памяти
+RESIDENCY_CHECK_INTERVAL_SECONDS = 60
+
+# Остановка генераций
+# Что делать с идущим ответом, если пользователь прислал новое сообщение:
+# "cancel" — остановить его (уже написанная часть попадёт в историю),
+# "wait" — дождаться его окончания и только потом отвечать на новое
+GENERATION_SUPERSEDE_POLICY = "cancel"
+
+# Долговременная память на эмбеддингах (нужен numpy)
+# Старые реплики не пересылаются целиком: они индексируются эмбеддингами,
+# а в запрос попадают только самые похожие на вопрос и несколько последних
+MEMORY_ENABLED = False
+# Модель эмбеддингов Ollama (должна быть скачана: ollama pull nomic-embed-text)
+MEMORY_EMBED_MODEL = "nomic-embed-text"
+# Папка с индексами пользователей (по два файла на пользователя: .vec и .jsonl)
+MEMORY_DIR = "memory"
+# Сколько похожих прошлых реплик добавлять в запрос
+MEMORY_TOP_K = 4
+# Минимальное косинусное сходство, чтобы реплика считалась относящейся к вопросу
+MEMORY_MIN_SCORE = 0.3
+# Сколько последних ходов (вопрос + ответ) передаётся дословно
+MEMORY_RECENT_TURNS = 3
+# Сколько реплик считать эмбеддингами за один запрос к Ollama
+MEMORY_EMBED_BATCH = 32
+# Как часто досчитывать эмбеддинги накопившихся реплик, секунд
+MEMORY_FLUSH_INTERVAL_SECONDS = 2.0
+# Сколько индексов держать загруженными в памяти (остальные читаются с диска)
+MEMORY_MAX_LOADED_USERS = 1000
+# Сколько ходов может ждать эмбеддинга (например, пока модель эмбеддингов недоступна).
+# Сверх этого старые реплики не переносятся в память и остаются в истории
+MEMORY_MAX_PENDING = 5000
+
+# Трассировка запросов: доля сообщений, для которых пишется трасса
+# (0 — выключено, 1 — все). Трассы — по JSON-объекту на строку в TRACE_FILE
+TRACE_SAMPLE_RATE = 0.0
+TRACE_FILE = "traces.jsonl"
+# Ротация файла трасс: размер одного файла и сколько старых хранить
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_FILE_BACKUPS = 3
+
+# Профилирование по запросу: команда /profile [секунды] (только для этих
+# пользователей) или сигнал SIGUSR1. Результаты — в PROFILE_DIR
+ADMIN_USER_IDS = []
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_DIR = "profiles"
+
+# Склейка серии сообщений: если пользователь пишет мысль несколькими сообщениями
+# подряд, ответ генерируется один раз на всю серию. Серия заканчивается, когда
+# пользователь молчит столько секунд (0 — не склеивать)
+INPUT_DEBOUNCE_SECONDS = 1.0
+# Дольше этого серия не копится, даже если сообщения продолжают приходить
+INPUT_DEBOUNCE_MAX_SECONDS = 5.0
+
+# Регулятор нагрузки: при росте очереди ответы укорачиваются (num_predict),
+# в промпт идёт меньше истории, а при сильной перегрузке запросы уходят на
+# запасную модель поменьше. num_ctx регулятор не трогает: другой размер
+# контекста заставил бы Ollama перезагружать модель в самый пик нагрузки. Нагрузка = (генерации в работе + в очереди) / GEN_MAX_CONCURRENT
+GOVERNOR_ENABLED = True
+# Уровни по возрастанию нагрузки: с какой нагрузки включается уровень и что он меняет.
+# context — сколько токенов контекста считать при подборе истории (вместо
+# MODEL_CONTEXT_TOKENS). Пропущенный параметр не ограничивается;
+# fallback — переходить ли на запасную модель
+GOVERNOR_LEVELS = [
+    {"load": 1.5, "num_predict": 768, "context": 3072, "deadline": 90},
+    {"load": 2.5, "num_predict": 384, "context": 2048, "deadline": 60},
+    {"load": 4.0, "num_predict": 256, "context": 1536, "deadline": 45, "fallback": True},
+]
+# Уровень понижается, когда нагрузка падает ниже порога уровня * это значение
+GOVERNOR_RELAX_RATIO = 0.7
+# Если средняя скорость генерации ниже этой (токенов/с) — регулятор строже на уровень
+GOVERNOR_MIN_TOKENS_PER_SECOND = 5.0
+# Запасные модели для перегрузки: модель пользователя -> модель поменьше ("*" — для всех)
+GOVERNOR_FALLBACK_MODELS = {}
+# Предельное время одного ответа без перегрузки, секунд (дальше ответ обрезается)
+GENERATION_DEADLINE_SECONDS = 180
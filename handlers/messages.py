@@ -5,7 +5,7 @@ from aiogram import F
 from aiogram.types import ContentType
 
 from aiogram import Router, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -16,9 +16,26 @@ import urllib.parse
 import math
 import logging
 import asyncio
-
-from storage import get_user
-from services.ollama_client import generate_stream, get_models
+import time
+from typing import Optional
+
+from storage import Session, get_user, pin_user, save_user
+from services.ollama_client import generate_stream
+from services.model_catalog import catalog
+from services.transcriber import transcriber, TranscriberBusy, TranscriberUnavailable
+from services.live_message import LiveMessage
+from services.scheduler import scheduler, QueueFull, QueueTimeout
+from services.history import build_context
+from services.memory import memory
+from services.response_cache import response_cache
+from services import metrics
+from services.residency import residency
+from services.generations import generations, Generation, GenerationStopped
+from services import tracing
+from services.debounce import debouncer
+from services.governor import governor
+from services.profiler import profiler, summary_head
+from config import ADMIN_USER_IDS, PROFILE_DEFAULT_SECONDS
 
 router = Router()
 
@@ -32,6 +49,8 @@ main_keyboard = ReplyKeyboardMarkup(
 )
 
 PAGE_SIZE = 8  # сколько моделей на страницу
+# Дописывается к ответу, обрезанному по предельному времени (в историю не попадает)
+DEADLINE_NOTICE = "\n\n⏱ Ответ обрезан: генерация заняла слишком много времени."
 
 
 # /start
@@ -46,28 +65,27 @@ async def cmd_start(message: types.Message):
 # Reply-кнопка "📋 Модель"
 @router.message(lambda m: m.text == "📋 Модель")
 async def on_choose_model(message: types.Message):
-    models = await get_models()
+    models = await catalog.get()
     if not models:
         await message.answer("⚠️ Не удалось получить список моделей. Проверь Ollama.")
         return
 
-    keyboard = build_models_keyboard(models, page=0)
+    keyboard = catalog.page(0, build_models_keyboard)
     await message.answer("Выбери модель:", reply_markup=keyboard)
 
 
-# Конструктор inline-клавиатуры для страниц
+def total_pages(models) -> int:
+    return max(1, math.ceil(len(models) / PAGE_SIZE))
+
+
+# Конструктор inline-клавиатуры для страниц (результат кэшируется в catalog.page)
 def build_models_keyboard(models, page: int) -> InlineKeyboardMarkup:
-    total_pages = max(1, math.ceil(len(models) / PAGE_SIZE))
-    print(f"total_pages: {total_pages}")
-    page = max(0, min(page, total_pages - 1))
-    print(f"page: {page}")
+    pages = total_pages(models)
+    page = max(0, min(page, pages - 1))
 
     start = page * PAGE_SIZE
-    print(f"start: {start}")
     end = start + PAGE_SIZE
-    print(f"end: {end}")
     slice_models = models[start:end]
-    print(f"slice_models: {slice_models}")
 
     rows = []
     for name in slice_models:
@@ -83,7 +101,7 @@ def build_models_keyboard(models, page: int) -> InlineKeyboardMarkup:
                 text="⬅️ Назад", callback_data=f"models_page:{page - 1}"
             )
         )
-    if page < total_pages - 1:
+    if page < pages - 1:
         nav.append(
             InlineKeyboardButton(
                 text="Вперед ➡️", callback_data=f"models_page:{page + 1}"
@@ -106,7 +124,7 @@ async def on_models_page(callback: types.CallbackQuery):
     except Exception:
         page = 0
 
-    models = await get_models()
+    models = await catalog.get()
     if not models:
         try:
             await callback.message.edit_text("⚠️ Не удалось получить список моделей.")
@@ -114,7 +132,9 @@ async def on_models_page(callback: types.CallbackQuery):
             await callback.message.answer("⚠️ Не удалось получить список моделей.")
         return
 
-    keyboard = build_models_keyboard(models, page=page)
+    # Ограничиваем номер страницы, чтобы кэш страниц не рос от произвольных callback_data
+    page = max(0, min(page, total_pages(models) - 1))
+    keyboard = catalog.page(page, build_models_keyboard)
     try:
         await callback.message.edit_text("Выбери модель:", reply_markup=keyboard)
     except Exception:
@@ -136,12 +156,39 @@ async def on_set_model(callback: types.CallbackQuery):
         return
 
     user = get_user(callback.from_user.id)
-    user["model"] = model_name
+    user.set_model(model_name)
+    save_user(callback.from_user.id, user)
 
+    # Загружаем модель в память Ollama заранее, пока пользователь пишет сообщение
+    text = f"✅ Модель изменена на: {model_name}"
+    if residency.warm(model_name) is not None:
+        text += "\n⏳ Загружаю модель в память — первый ответ может занять чуть больше времени."
     try:
-        await callback.message.edit_text(f"✅ Модель изменена на: {model_name}")
+        await callback.message.edit_text(text)
     except Exception:
-        await callback.message.answer(f"✅ Модель изменена на: {model_name}")
+        await callback.message.answer(text)
+
+
+def stop_keyboard(generation: Generation) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="⏹ Стоп", callback_data=f"stop:{generation.id}")]
+        ]
+    )
+
+
+# Кнопка "⏹ Стоп" под генерируемым ответом
+@router.callback_query(lambda c: c.data and c.data.startswith("stop:"))
+async def on_stop(callback: types.CallbackQuery):
+    try:
+        gen_id = int(callback.data.split(":", 1)[1])
+    except ValueError:
+        await callback.answer()
+        return
+    if generations.stop(callback.from_user.id, gen_id):
+        await callback.answer("⏹ Останавливаю...")
+    else:
+        await callback.answer("Ответ уже завершён.")
 
 
 # Закрыть меню моделей
@@ -161,7 +208,8 @@ async def on_models_close(callback: types.CallbackQuery):
 @router.message(lambda m: m.text == "🎛 Prompt")
 async def on_change_prompt(message: types.Message):
     user = get_user(message.from_user.id)
-    user["waiting_for_prompt"] = True
+    user.waiting_for_prompt = True
+    save_user(message.from_user.id, user)
     await message.answer("✍️ Отправь новый system prompt одним сообщением.")
 
 
@@ -169,147 +217,291 @@ async def on_change_prompt(message: types.Message):
 @router.message(lambda m: m.text == "🧹 Очистить")
 async def on_clear_history(message: types.Message):
     user = get_user(message.from_user.id)
-    user["history"] = []
+    user.history = []
+    user.summary = ""
+    save_user(message.from_user.id, user)
+    await memory.forget(message.from_user.id)
     await message.answer("🧹 История очищена.")
 
 
+async def stream_reply(
+    placeholder: types.Message,
+    user_id: int,
+    user: Session,
+    prompt: str,
+    live: Optional[LiveMessage] = None,
+    generation: Optional[Generation] = None,
+) -> Optional[str]:
+    """
+    Стримит ответ модели в сообщение-заглушку и возвращает полный текст ответа.
+    Куски ответа копятся в LiveMessage, который сам решает, когда править сообщение,
+    поэтому чтение стрима от Ollama никогда не ждёт Telegram.
+    Генерация запускается через планировщик; пока запрос в очереди, в заглушке
+    показывается его позиция. Если запрос не дождался очереди — возвращает None.
+    При включённом кэше ответ может прийти из кэша или из чужой такой же генерации.
+    Модель, параметры генерации и предельное время ответа выбирает регулятор нагрузки.
+    live — уже созданное живое сообщение для заглушки (например, после распознавания голоса).
+    Если передан generation, под ответом есть кнопка ⏹; после остановки возвращается
+    уже написанная часть ответа (или None, если модель ничего не успела написать).
+    """
+    if live is None:
+        live = LiveMessage(placeholder)
+    if generation is not None:
+        live.reply_markup = stop_keyboard(generation)
+
+    async def on_position(pos: int):
+        live.status(f"⏳ Вы в очереди: {pos}. Ответ начнётся, как только освободится место.")
+
+    # Под нагрузкой регулятор может укоротить ответ или сменить модель на запасную
+    plan = governor.plan(user.model)
+    model = plan.model
+    system_prompt = user.system_prompt
+    try:
+        with tracing.span("build_context"):
+            history = await build_context(user_id, user, model, prompt, plan.context_tokens)
+    except BaseException:
+        governor.release()
+        raise
+    started = time.monotonic()
+    first_chunk_at = None
+
+    async def on_chunk(chunk: str):
+        nonlocal first_chunk_at
+        if first_chunk_at is None:
+            first_chunk_at = time.monotonic()
+            metrics.time_to_first_token.observe(first_chunk_at - started, model=model)
+        await live.feed(chunk)
+
+    async def run(on_chunk) -> Optional[dict]:
+        async with scheduler.slot(user_id, model, on_position=on_position) as waited:
+            metrics.queue_wait.observe(waited, model=model)
+            tracing.record("queue", waited)
+            if model != user.model:
+                live.status(f"⏳ Сервер сейчас загружен — отвечает облегчённая модель {model}...")
+            elif residency.is_resident(model):
+                live.status("⏳ Генерирую...")
+            else:
+                live.status(
+                    f"⏳ Загружаю модель {model} в память — ответ займёт больше времени, "
+                    "чем обычно..."
+                )
+            with tracing.span("generate", model=model, level=plan.level) as s:
+                try:
+                    stats = await asyncio.wait_for(
+                        generate_stream(
+                            model=model,
+                            system_prompt=system_prompt,
+                            history=history,
+                            user_prompt=prompt,
+                            on_chunk=on_chunk,
+                            options=plan.options,
+                        ),
+                        plan.deadline,
+                    )
+                except asyncio.TimeoutError:
+                    # Стрим отменён, соединение с Ollama закрыто; написанное остаётся.
+                    # Пометку получат и подписчики общей генерации, а по truncated
+                    # каждый из них уберёт её из своей истории (в кэш такой ответ не попадёт)
+                    governor.deadline_exceeded(plan)
+                    await on_chunk(DEADLINE_NOTICE)
+                    return {"truncated": True}
+                if stats:
+                    s.set(**{k: v for k, v in stats.items() if k.endswith(("_count", "_duration"))})
+            # Статистику Ollama учитываем только здесь — у реальной генерации,
+            # а не у ответов из кэша и подписчиков
+            metrics.observe_ollama_stats(model, stats)
+            governor.observe(stats)
+            return stats
+
+    outcome = "error"
+    try:
+        # Одинаковые запросы отдаются из кэша или подписываются на уже идущую генерацию.
+        # Урезанные регулятором ответы не смешиваются в кэше с обычными
+        cache_model = model if plan.level == 0 else f"{model}#level{plan.level}"
+        reply = response_cache.generate(cache_model, system_prompt, history, prompt, on_chunk, run)
+        stats = await (generation.run(reply) if generation is not None else reply)
+        if stats is not None:
+            if stats.get("truncated"):
+                outcome = "deadline"
+            else:
+                outcome = "cached" if stats.get("cached") else "ok"
+    except GenerationStopped:
+        outcome = "stopped"
+        partial = live.text
+        if partial:
+            await live.feed("\n\n⏹ Остановлено.")
+            await live.finish()
+        else:
+            await live.finish("⏹ Генерация остановлена.")
+        return partial or None
+    except QueueFull:
+        outcome = "queue_full"
+        await live.finish("⚠️ Сейчас слишком много запросов. Попробуйте чуть позже.")
+        return None
+    except QueueTimeout:
+        outcome = "queue_timeout"
+        await live.finish("⚠️ Не дождались очереди на генерацию. Попробуйте ещё раз.")
+        return None
+    finally:
+        governor.release()
+        if not live.closed:
+            await live.finish(None if live.text else "⚠️ Модель вернула пустой ответ.")
+        metrics.generations.inc(model=model, outcome=outcome)
+        tracing.annotate(model=model, outcome=outcome, edits=live.edits, segments=live.segments)
+        metrics.edits_per_reply.observe(live.edits, model=model)
+    metrics.generation_seconds.observe(time.monotonic() - started, model=model)
+    metrics.reply_chars.observe(len(live.text), model=model)
+    # В историю идёт сам ответ, без пометки об обрезке; если модель не успела
+    # ничего написать — записывать нечего
+    if outcome == "deadline":
+        text = live.text
+        if text.endswith(DEADLINE_NOTICE):
+            text = text[: -len(DEADLINE_NOTICE)]
+        return text or None
+    return live.text
+
+
 @router.message(F.content_type == ContentType.VOICE)
 async def handle_voice(message: types.Message):
+    # Сессия держится в памяти до записи ответа в историю
+    with tracing.trace("voice", user_id=message.from_user.id), pin_user(message.from_user.id):
+        await _handle_voice(message)
+
+
+async def _handle_voice(message: types.Message):
     user = get_user(message.from_user.id)
 
     # Если ждём prompt — игнорируем голосовые (или можно адаптировать)
-    if user.get("waiting_for_prompt"):
+    if user.waiting_for_prompt:
         await message.answer("⚠️ Ожидаю текстовый system prompt.")
         return
 
     placeholder = await message.answer("🎤 Распознаю голосовое сообщение...")
 
     try:
-        # Скачиваем файл
+        # Скачиваем файл в память — на диск ничего не пишем
         file_id = message.voice.file_id
-        file = await message.bot.get_file(file_id)
-        downloaded_file = await message.bot.download_file(file.file_path)
-
-        # Сохраняем временно (или можно в память с BytesIO)
-        temp_filename = f"temp_voice_{message.message_id}.ogg"
-        with open(temp_filename, "wb") as f:
-            f.write(downloaded_file.read())
-
-        # Транскрипция (пример с faster-whisper)
-        from faster_whisper import WhisperModel
-
-        model = WhisperModel(
-            "small"
-        )  # или "base", "medium" — в зависимости от ресурсов; "small" хорошо для русского
-        segments, info = model.transcribe(
-            temp_filename, language="ru"
-        )  # явно указываем русский
-        transcribed_text = " ".join(seg.text for seg in segments).strip()
-
-        # Удаляем временный файл
-        import os
-
-        os.remove(temp_filename)
+        with tracing.span("telegram.download"):
+            file = await message.bot.get_file(file_id)
+            audio = await message.bot.download_file(file.file_path)
+
+        # Распознанные сегменты показываем в заглушке по мере готовности;
+        # правки идут с тем же ограничением частоты, что и при стриминге ответа
+        live = LiveMessage(placeholder)
+        segments = []
+        try:
+            with tracing.span("transcribe", duration=message.voice.duration):
+                async for segment in transcriber.stream(audio, message.voice.duration or 0):
+                    segments.append(segment)
+                    live.status("🎤 " + " ".join(segments) + " …")
+        except TranscriberBusy:
+            await live.finish("⚠️ Сейчас много голосовых в очереди. Попробуйте чуть позже.")
+            return
+        except TranscriberUnavailable:
+            await live.finish("⚠️ Распознавание речи сейчас недоступно.")
+            return
+        finally:
+            audio.close()
+        transcribed_text = " ".join(segments).strip()
 
         if not transcribed_text:
-            await placeholder.edit_text(
-                "⚠️ Не удалось распознать речь. Попробуйте говорить чётче."
-            )
+            await live.finish("⚠️ Не удалось распознать речь. Попробуйте говорить чётче.")
             return
 
-        await placeholder.edit_text(
-            f"🎤 Распознано: {transcribed_text}\n\n⏳ Генерирую ответ..."
-        )
-
-        # Теперь используем тот же код генерации, что и для текста
-        # Лучше вынести в отдельную функцию, но для примера дублируем логику
-        full_text = ""
-        buffer_text = ""
-
-        async def on_chunk(chunk: str):
-            nonlocal full_text, buffer_text
-            buffer_text += chunk
-            if len(buffer_text) > 20:
-                full_text += buffer_text
-                try:
-                    await placeholder.edit_text(full_text[:4000])
-                except Exception:
-                    pass
-                buffer_text = ""
-                await asyncio.sleep(0.1)
-
-        await generate_stream(
-            model=user["model"],
-            system_prompt=user["system_prompt"],
-            history=user["history"],
-            user_prompt=transcribed_text,
-            on_chunk=on_chunk,
-        )
-
-        full_text += buffer_text
-        await placeholder.edit_text(full_text[:4000])
+        # Генерация стартует сразу, не дожидаясь правки с распознанным текстом:
+        # то же живое сообщение продолжает показывать статус, а затем ответ
+        live.status(f"🎤 Распознано: {transcribed_text}\n\n⏳ Генерирую ответ...")
+        async with generations.turn(message.from_user.id) as generation:
+            full_text = await stream_reply(
+                placeholder,
+                message.from_user.id,
+                user,
+                transcribed_text,
+                live=live,
+                generation=generation,
+            )
+            if full_text is None:
+                return
 
-        # Сохраняем в историю (голосовое как текст пользователя)
-        user["history"].append(
-            {"role": "user", "content": f"[Голосовое] {transcribed_text}"}
-        )
-        user["history"].append({"role": "assistant", "content": full_text})
+            # Сохраняем в историю (голосовое как текст пользователя)
+            user.add_turn(f"[Голосовое] {transcribed_text}", full_text)
+            memory.remember(message.from_user.id, user)
+            save_user(message.from_user.id, user)
 
     except Exception as e:
         logging.exception("Ошибка при обработке голосового")
         await placeholder.edit_text(f"❌ Ошибка: {e}")
 
 
+# /profile [секунды] — профиль бота под текущей нагрузкой (только для админов)
+@router.message(Command("profile"), F.from_user.id.in_(ADMIN_USER_IDS))
+async def cmd_profile(message: types.Message, command: CommandObject):
+    try:
+        seconds = float(command.args) if command.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await message.answer("Использование: /profile [секунды]")
+        return
+    if profiler.running:
+        await message.answer("⏱ Профилирование уже идёт.")
+        return
+    seconds = max(1.0, min(seconds, profiler.max_seconds))
+    await message.answer(f"⏱ Профилирую {seconds:.0f} с...")
+    path = await profiler.run(seconds)
+    head = await asyncio.to_thread(summary_head, path)
+    await message.answer(f"📄 {path}\n\n{head}")
+
+
 # Основной чат
 @router.message()
 async def on_chat(message: types.Message):
+    with tracing.trace("chat", user_id=message.from_user.id), pin_user(message.from_user.id):
+        await _handle_chat(message)
+
+
+async def _handle_chat(message: types.Message):
     user = get_user(message.from_user.id)
+    # Подпись к фото/документу тоже считаем текстом сообщения
+    text = message.text or message.caption or ""
 
     # Если ждем новый system prompt
-    if user.get("waiting_for_prompt"):
-        user["system_prompt"] = message.text
-        user["waiting_for_prompt"] = False
+    if user.waiting_for_prompt:
+        if not text:
+            await message.answer("⚠️ Ожидаю текстовый system prompt.")
+            return
+        user.set_system_prompt(text)
+        user.waiting_for_prompt = False
+        save_user(message.from_user.id, user)
         await message.answer("✅ System prompt обновлён.")
         return
 
-    placeholder = await message.answer("⏳ Генерирую...")
-
-    full_text = ""
-    buffer_text = ""
-
-    # Буферизированная функция on_chunk
-    async def on_chunk(chunk: str):
-        nonlocal full_text, buffer_text
-        buffer_text += chunk
-        if len(buffer_text) > 20:
-            full_text += buffer_text
-            try:
-                await placeholder.edit_text(full_text[:4000])
-            except Exception:
-                logging.exception("Не удалось обновить сообщение")
-            buffer_text = ""
-            # даём Telegram немного “отдыха”
-            await asyncio.sleep(0.1)
+    # Без текста отвечать не на что — разве что это часть альбома с подписью
+    if not text and not message.media_group_id:
+        return
 
-    try:
-        await generate_stream(
-            model=user["model"],
-            system_prompt=user["system_prompt"],
-            history=user["history"],
-            user_prompt=message.text,
-            on_chunk=on_chunk,
-        )
-    except Exception as e:
-        await message.answer(f"❌ Ошибка при генерации: {e}")
+    # Серия быстрых сообщений склеивается в один запрос: отвечает только первое
+    # сообщение серии, остальные лишь дописывают в неё свой текст
+    with tracing.span("debounce"):
+        prompt = await debouncer.collect((message.chat.id, message.from_user.id), text)
+    if not prompt:
         return
 
-    # Отправляем оставшийся буфер
-    full_text += buffer_text
-    try:
-        await placeholder.edit_text(full_text[:4000])
-    except Exception:
-        pass
+    with tracing.span("telegram.send"):
+        placeholder = await message.answer("⏳ Генерирую...")
+
+    # Ход держится до записи в историю: следующее сообщение увидит её целиком
+    async with generations.turn(message.from_user.id) as generation:
+        try:
+            full_text = await stream_reply(
+                placeholder, message.from_user.id, user, prompt, generation=generation
+            )
+        except Exception as e:
+            await message.answer(f"❌ Ошибка при генерации: {e}")
+            return
+        if full_text is None:
+            return
 
-    # Сохраняем историю
-    user["history"].append({"role": "user", "content": message.text})
-    user["history"].append({"role": "assistant", "content": full_text})
+        # Сохраняем историю
+        user.add_turn(prompt, full_text)
+        # Старые реплики переезжают в долговременную память (если она включена)
+        memory.remember(message.from_user.id, user)
+        save_user(message.from_user.id, user)
@@ -3,27 +3,154 @@
 
 import asyncio
 import logging
+import signal
 from aiogram import F
 from aiogram.types import ContentType
 
 from aiogram import Bot, Dispatcher
-from config import TOKEN
+from config import (
+    TOKEN,
+    LOG_LEVEL,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    RUN_MODE,
+    PROFILE_DEFAULT_SECONDS,
+)
 from handlers.messages import router
+from services.ollama_client import client as ollama_client, pool as ollama_pool
+from services.transcriber import transcriber
+from services import metrics
+from services.scheduler import scheduler
+from services.residency import residency
+from services.memory import memory
+from services.profiler import profiler
+from services.governor import governor
+from services.response_cache import response_cache
+from storage import store
 
-# Включаем логирование
-logging.basicConfig(level=logging.DEBUG)
+# Включаем логирование (DEBUG заметно замедляет стриминг — только для отладки)
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+# HTTP-сервер метрик (если включён)
+metrics_runner = None
+
+
+def register_gauges():
+    """
+    Текущее состояние пула соединений и очереди — читается при каждом запросе /metrics.
+    Регистрируется при старте, а не при импорте: в режиме webhook воркеры
+    импортируют этот модуль повторно, а метрики не должны дублироваться.
+    """
+    metrics.Gauge("hubert_ollama_pool_in_use", "Занятых соединений к Ollama",
+                  lambda: ollama_client.stats()["in_use"])
+    metrics.Gauge("hubert_ollama_pool_idle", "Свободных keep-alive соединений к Ollama",
+                  lambda: ollama_client.stats()["idle"])
+    metrics.Gauge("hubert_ollama_pool_reuse_ratio", "Доля переиспользованных соединений",
+                  lambda: ollama_client.stats()["reuse_ratio"])
+    metrics.Gauge("hubert_ollama_nodes_healthy", "Живых узлов Ollama",
+                  lambda: len(ollama_pool.healthy_nodes()))
+    metrics.Gauge("hubert_generations_in_flight", "Генераций в работе", lambda: scheduler.in_flight)
+    metrics.Gauge("hubert_generations_queued", "Генераций в очереди", lambda: scheduler.queued)
+    metrics.Gauge("hubert_governor_level", "Уровень регулятора нагрузки", lambda: governor.level)
+    metrics.Gauge("hubert_sessions", "Сессий пользователей в памяти",
+                  lambda: store.stats()["sessions"])
+    metrics.Gauge("hubert_sessions_bytes", "Примерный объём сессий в памяти, байт",
+                  lambda: store.stats()["bytes"])
+    # Кэш ответов (RESPONSE_CACHE_ENABLED); hit/join/miss — счётчик
+    # hubert_response_cache_requests_total
+    metrics.Gauge("hubert_response_cache_entries", "Ответов в кэше",
+                  lambda: response_cache.stats()["entries"])
+    metrics.Gauge("hubert_response_cache_bytes", "Объём кэша ответов, байт",
+                  lambda: response_cache.stats()["bytes"])
+
+
+async def on_startup(worker_index: int = 0, workers: int = 1):
+    # Лимиты генераций общие на все воркеры — каждому достаётся своя доля
+    # (регулятор нагрузки считает нагрузку относительно неё же)
+    scheduler.share(workers)
+    # Один пул соединений к Ollama на всё время работы бота
+    await ollama_client.start()
+    # Первая проверка узлов Ollama и периодический health-check
+    await ollama_pool.start()
+    # Прогрев закреплённых моделей и контроль, что они остаются в памяти —
+    # достаточно одного воркера
+    if worker_index == 0:
+        await residency.start()
+    # Фоновая пакетная запись настроек пользователей
+    await store.start()
+    # Долговременная память: фоновый расчёт эмбеддингов (если включена)
+    await memory.start()
+    global metrics_runner
+    if METRICS_ENABLED:
+        register_gauges()
+        # У каждого воркера (в режиме webhook) свой порт метрик
+        metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + worker_index)
+    # Модели Whisper грузятся и прогреваются в фоне, чтобы не задерживать старт бота;
+    # первые голосовые просто подождут окончания загрузки
+    task = asyncio.create_task(transcriber.start())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    # kill -USR1 <pid> — профиль под текущей нагрузкой (см. services/profiler.py)
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, on_profile_signal)
+
+
+def on_profile_signal():
+    if profiler.running:
+        logger.info("Профилирование уже идёт")
+        return
+    task = asyncio.create_task(profiler.run(PROFILE_DEFAULT_SECONDS))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def on_shutdown():
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    logger.info("Пул соединений Ollama: %s", ollama_client.stats())
+    await residency.close()
+    # Досчитываем эмбеддинги, пока соединение с Ollama ещё открыто
+    await memory.close()
+    await ollama_pool.close()
+    await ollama_client.close()
+    await transcriber.close()
+    # Сохраняем всё, что ещё не успело записаться
+    logger.info("Сессии пользователей: %s", store.stats())
+    await store.close()
+
+
+def create_dispatcher(worker_index: int = 0, workers: int = 1) -> Dispatcher:
+    """
+    Dispatcher со всеми обработчиками и хуками запуска/остановки.
+    worker_index и workers — номер воркера и их число в режиме webhook.
+    """
+    dp = Dispatcher(worker_index=worker_index, workers=workers)
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
 async def main():
     bot = Bot(token=TOKEN)
-    dp = Dispatcher()
-    dp.include_router(router)
+    dp = create_dispatcher()
 
     logger.info("Запускаем бота...")
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if RUN_MODE == "webhook":
+            import webhook
+
+            webhook.run()
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Бот остановлен вручную")
@@ -0,0 +1,73 @@
+# services/debounce.py
+# Склейка серии сообщений одного пользователя в один запрос.
+# Первое сообщение серии ждёт, пока пользователь помолчит quiet секунд;
+# каждое следующее сообщение продлевает ожидание (но не дольше max_wait
+# от начала серии) и просто добавляет свой текст. В итоге на всю серию —
+# одна генерация с общим текстом, а не по генерации на каждое сообщение.
+
+import asyncio
+import logging
+import time
+from typing import Dict, Hashable, List, Optional
+
+from config import INPUT_DEBOUNCE_SECONDS, INPUT_DEBOUNCE_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class _Burst:
+    __slots__ = ("parts", "deadline", "hard_deadline")
+
+    def __init__(self, now: float, quiet: float, max_wait: float):
+        self.parts: List[str] = []
+        self.deadline = now + quiet
+        self.hard_deadline = now + max_wait
+
+
+class InputDebouncer:
+    def __init__(self, quiet: float, max_wait: float):
+        self.quiet = quiet
+        self.max_wait = max(quiet, max_wait)
+        self._bursts: Dict[Hashable, _Burst] = {}
+
+    async def collect(self, key: Hashable, text: str) -> Optional[str]:
+        """
+        Добавляет сообщение в серию key. Для первого сообщения серии возвращает
+        склеенный текст всей серии (после паузы), для остальных — None:
+        их текст уже попал в серию, отвечать на них отдельно не нужно.
+        Пустой текст (например, фото без подписи из альбома) только продлевает серию.
+        """
+        if self.quiet <= 0:
+            return text
+        now = time.monotonic()
+        burst = self._bursts.get(key)
+        if burst is not None:
+            if text:
+                burst.parts.append(text)
+            burst.deadline = min(now + self.quiet, burst.hard_deadline)
+            return None
+
+        burst = _Burst(now, self.quiet, self.max_wait)
+        if text:
+            burst.parts.append(text)
+        self._bursts[key] = burst
+        try:
+            while True:
+                delay = burst.deadline - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            if self._bursts.get(key) is burst:
+                del self._bursts[key]
+        if len(burst.parts) > 1:
+            logger.debug("Склеено сообщений в серии %s: %d", key, len(burst.parts))
+        return "\n".join(burst.parts)
+
+    @property
+    def pending(self) -> int:
+        """Сколько серий сейчас копится."""
+        return len(self._bursts)
+
+
+debouncer = InputDebouncer(INPUT_DEBOUNCE_SECONDS, INPUT_DEBOUNCE_MAX_SECONDS)
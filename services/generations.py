@@ -0,0 +1,107 @@
+# services/generations.py
+# Реестр идущих генераций. У пользователя одновременно не больше одного «хода»:
+# генерация ответа и запись его в историю. Ход можно остановить кнопкой ⏹
+# или новым сообщением (GENERATION_SUPERSEDE_POLICY). Остановка отменяет задачу
+# генерации, а вместе с ней закрывается HTTP-ответ Ollama — модель перестаёт
+# тратить время на ответ, который никто не прочитает.
+
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import Awaitable, Dict, Optional, TypeVar
+
+from config import GENERATION_SUPERSEDE_POLICY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class GenerationStopped(Exception):
+    """Генерацию остановил пользователь (кнопкой или новым сообщением)."""
+
+
+class Generation:
+    def __init__(self, user_id: int, gen_id: int):
+        self.user_id = user_id
+        self.id = gen_id
+        self.stopped = False
+        self.finished = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def stop(self) -> bool:
+        """Останавливает генерацию; False — если она уже закончилась или остановлена."""
+        if self.stopped or self.finished.is_set():
+            return False
+        self.stopped = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        return True
+
+    async def run(self, aw: Awaitable[T]) -> T:
+        """
+        Выполняет генерацию отдельной задачей, чтобы её можно было отменить,
+        не трогая обработчик. Бросает GenerationStopped, если её остановили.
+        """
+        if self.stopped:
+            if asyncio.iscoroutine(aw):
+                aw.close()
+            raise GenerationStopped()
+        self._task = asyncio.ensure_future(aw)
+        try:
+            return await self._task
+        except asyncio.CancelledError:
+            # Отменили именно генерацию, а не весь обработчик
+            if self.stopped and self._task.cancelled():
+                raise GenerationStopped() from None
+            raise
+        finally:
+            self._task = None
+
+
+class GenerationRegistry:
+    def __init__(self, policy: str):
+        self.policy = policy
+        self._active: Dict[int, Generation] = {}
+        self._ids = itertools.count(1)
+
+    def get(self, user_id: int) -> Optional[Generation]:
+        return self._active.get(user_id)
+
+    def stop(self, user_id: int, gen_id: Optional[int] = None) -> bool:
+        """Останавливает текущую генерацию пользователя (если gen_id задан — только её)."""
+        gen = self._active.get(user_id)
+        if gen is None or (gen_id is not None and gen.id != gen_id):
+            return False
+        return gen.stop()
+
+    @asynccontextmanager
+    async def turn(self, user_id: int):
+        """
+        Ход пользователя: ждёт (или останавливает — по политике) предыдущий
+        и держит новую генерацию зарегистрированной до выхода из блока.
+        """
+        while True:
+            prev = self._active.get(user_id)
+            if prev is None:
+                break
+            if self.policy == "cancel":
+                prev.stop()
+            # Предыдущий ход допишет историю, и только потом начнётся новый
+            await prev.finished.wait()
+        gen = Generation(user_id, next(self._ids))
+        self._active[user_id] = gen
+        try:
+            yield gen
+        finally:
+            if self._active.get(user_id) is gen:
+                del self._active[user_id]
+            gen.finished.set()
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+
+generations = GenerationRegistry(GENERATION_SUPERSEDE_POLICY)
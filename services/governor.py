@@ -0,0 +1,155 @@
+# services/governor.py
+# Регулятор нагрузки на Ollama. Следит за числом генераций в работе и в очереди
+# и за средней скоростью генерации; при росте нагрузки ужесточает параметры
+# новых запросов (num_predict, объём истории в промпте, предельное время ответа) и при сильной
+# перегрузке отправляет их на запасную модель поменьше. Когда нагрузка спадает,
+# уровень понижается (с запасом, чтобы не дёргаться на границе) и запросы снова
+# идут с настройками пользователя. Каждое изменение логируется и считается в метриках.
+
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from config import (
+    GOVERNOR_ENABLED,
+    GOVERNOR_LEVELS,
+    GOVERNOR_RELAX_RATIO,
+    GOVERNOR_MIN_TOKENS_PER_SECOND,
+    GOVERNOR_FALLBACK_MODELS,
+    GENERATION_DEADLINE_SECONDS,
+)
+from services import metrics
+from services.scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Вес нового замера в скользящем среднем скорости генерации
+_TPS_ALPHA = 0.2
+
+
+@dataclass
+class Plan:
+    """
+    Как выполнить конкретный запрос: модель, параметры Ollama, предельное время
+    и сколько токенов контекста отдавать под историю (None — сколько позволяет модель).
+    """
+
+    model: str
+    deadline: float
+    level: int = 0
+    options: Dict[str, int] = field(default_factory=dict)
+    context_tokens: Optional[int] = None
+
+
+class LoadGovernor:
+    def __init__(
+        self,
+        enabled: bool,
+        levels: List[dict],
+        relax_ratio: float,
+        min_tokens_per_second: float,
+        fallbacks: Dict[str, str],
+        deadline: float,
+    ):
+        self.enabled = enabled
+        self.levels = sorted(levels, key=lambda lv: lv["load"])
+        self.relax_ratio = relax_ratio
+        self.min_tokens_per_second = min_tokens_per_second
+        self.fallbacks = fallbacks
+        self.deadline = deadline
+        self.level = 0
+        # Запросов между plan() и release(): в очереди, в работе и ещё только
+        # собирающихся в очередь (при всплеске планировщик видит их не сразу)
+        self.active = 0
+        # Скользящее среднее токенов в секунду по последним генерациям
+        self.tokens_per_second: Optional[float] = None
+
+    def load(self) -> float:
+        busy = max(self.active, scheduler.in_flight + scheduler.queued)
+        return busy / scheduler.max_concurrent
+
+    def _update(self) -> int:
+        load = self.load()
+        level = self.level
+        while level < len(self.levels) and load >= self.levels[level]["load"]:
+            level += 1
+        while level > 0 and load < self.levels[level - 1]["load"] * self.relax_ratio:
+            level -= 1
+        if level != self.level:
+            log = logger.warning if level > self.level else logger.info
+            log("Регулятор нагрузки: уровень %d -> %d (нагрузка %.2f)", self.level, level, load)
+            metrics.governor_level_changes.inc(direction="up" if level > self.level else "down")
+            self.level = level
+
+        # Под нагрузкой и при медленной генерации — на уровень строже
+        slow = (
+            self.tokens_per_second is not None
+            and self.tokens_per_second < self.min_tokens_per_second
+        )
+        if slow and 0 < level < len(self.levels):
+            return level + 1
+        return level
+
+    def plan(self, model: str) -> Plan:
+        """
+        Параметры для нового запроса к модели model с учётом текущей нагрузки.
+        Когда запрос завершён, нужно вызвать release().
+        """
+        self.active += 1
+        if not self.enabled:
+            return Plan(model, self.deadline)
+        level = self._update()
+        if level == 0:
+            return Plan(model, self.deadline)
+
+        cfg = self.levels[level - 1]
+        plan = Plan(
+            model,
+            cfg.get("deadline", self.deadline),
+            level,
+            {"num_predict": cfg["num_predict"]} if "num_predict" in cfg else {},
+            cfg.get("context"),
+        )
+        if cfg.get("fallback"):
+            fallback = self.fallbacks.get(model, self.fallbacks.get("*"))
+            if fallback and fallback != model:
+                plan.model = fallback
+                metrics.governor_adjustments.inc(kind="fallback")
+        for kind in plan.options:
+            metrics.governor_adjustments.inc(kind=kind)
+        if plan.context_tokens:
+            metrics.governor_adjustments.inc(kind="context")
+        logger.info(
+            "Регулятор нагрузки (уровень %d): %s -> %s, %s, контекст %s, до %.0f с",
+            level, model, plan.model, plan.options, plan.context_tokens, plan.deadline,
+        )
+        return plan
+
+    def release(self):
+        self.active -= 1
+
+    def observe(self, stats: Optional[dict]):
+        """Учитывает скорость завершившейся генерации (статистика Ollama)."""
+        if not stats or not stats.get("eval_count") or not stats.get("eval_duration"):
+            return
+        tps = stats["eval_count"] / (stats["eval_duration"] * 1e-9)
+        if self.tokens_per_second is None:
+            self.tokens_per_second = tps
+        else:
+            self.tokens_per_second += _TPS_ALPHA * (tps - self.tokens_per_second)
+
+    def deadline_exceeded(self, plan: Plan):
+        metrics.governor_adjustments.inc(kind="deadline")
+        logger.warning(
+            "Ответ модели %s обрезан: превышено время генерации %.0f с", plan.model, plan.deadline
+        )
+
+
+governor = LoadGovernor(
+    enabled=GOVERNOR_ENABLED,
+    levels=GOVERNOR_LEVELS,
+    relax_ratio=GOVERNOR_RELAX_RATIO,
+    min_tokens_per_second=GOVERNOR_MIN_TOKENS_PER_SECOND,
+    fallbacks=GOVERNOR_FALLBACK_MODELS,
+    deadline=GENERATION_DEADLINE_SECONDS,
+)
@@ -0,0 +1,196 @@
+# services/history.py
+# Управление историей диалога с бюджетом токенов.
+# В запрос попадают только последние реплики, которые помещаются в бюджет модели,
+# а более старые сжимаются в краткое содержание (summary) фоновым запросом к Ollama.
+# При включённой долговременной памяти (services/memory.py) вместо сжатия
+# в запрос добавляются прошлые реплики, похожие на текущий вопрос.
+
+import asyncio
+import logging
+import math
+from typing import Dict, List, Optional
+
+from config import (
+    HISTORY_BUDGET_RATIO,
+    HISTORY_CHARS_PER_TOKEN,
+    HISTORY_KEEP_RECENT,
+)
+from services.ollama_client import context_size, generate_once
+from services.scheduler import scheduler, QueueFull, QueueTimeout
+from services.memory import memory
+from storage import Session, save_user
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_INSTRUCTION = (
+    "Сожми диалог ниже в краткое содержание на русском языке. Сохрани факты о "
+    "пользователе, его просьбы, договорённости и важные детали ответов. "
+    "Пиши только содержание, без вступлений."
+)
+
+# user_id -> задача сжатия истории (не больше одной на пользователя)
+_compactions: Dict[int, asyncio.Task] = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов в тексте (без обращения к токенизатору)."""
+    return math.ceil(len(text) / HISTORY_CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+
+def history_budget(model: str, context: Optional[int] = None) -> int:
+    """
+    Сколько токенов контекста модели можно отдать под system prompt и историю.
+    context — сколько токенов контекста считать вместо полного (регулятор нагрузки
+    урезает историю, но сам num_ctx запроса не меняется).
+    """
+    # Столько же уходит в Ollama как num_ctx, так что бюджет совпадает с реальным окном
+    limit = context_size(model)
+    if context:
+        limit = min(limit, context)
+    return int(limit * HISTORY_BUDGET_RATIO)
+
+
+def _summary_message(summary: str) -> dict:
+    return {"role": "system", "content": f"Краткое содержание предыдущего диалога:\n{summary}"}
+
+
+def build_history(
+    user_id: int, user: Session, model: str, prompt: str = "", context: Optional[int] = None
+) -> List[dict]:
+    """
+    Возвращает историю для запроса: summary (если есть) и столько последних
+    реплик, сколько помещается в бюджет. Если вся история в бюджет не влезает —
+    в фоне запускается её сжатие, текущий запрос при этом не ждёт.
+    """
+    history = user.history
+    summary = user.summary
+
+    budget = history_budget(model, context)
+    budget -= estimate_tokens(user.system_prompt) + estimate_tokens(prompt)
+    if summary:
+        budget -= estimate_tokens(summary)
+
+    # Идём с конца и набираем реплики, пока хватает бюджета
+    used = 0
+    start = len(history)
+    while start > 0:
+        cost = estimate_tokens(history[start - 1][1])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+
+    # При урезанном под нагрузкой контексте не сжимаем: это лишний запрос к Ollama
+    # в самый неподходящий момент, а история влезет в обычный бюджет
+    if start > 0 and not context:
+        schedule_compaction(user_id, user, model)
+
+    messages = [_summary_message(summary)] if summary else []
+    messages.extend(user.messages(start))
+    return messages
+
+
+async def build_context(
+    user_id: int, user: Session, model: str, prompt: str, context: Optional[int] = None
+) -> List[dict]:
+    """
+    История для запроса. Без долговременной памяти — то же, что build_history.
+    С памятью — summary (если осталось), найденные по смыслу прошлые ходы
+    и последние реплики дословно; размер запроса не растёт с длиной диалога.
+    """
+    if not memory.enabled:
+        return build_history(user_id, user, model, prompt, context)
+
+    summary = user.summary
+    recent = user.messages()
+    budget = history_budget(model, context)
+    budget -= estimate_tokens(user.system_prompt) + estimate_tokens(prompt)
+    budget -= sum(estimate_tokens(m["content"]) for m in recent)
+    if summary:
+        budget -= estimate_tokens(summary)
+
+    recalled = []
+    for text in await memory.recall(user_id, prompt):
+        cost = estimate_tokens(text)
+        if cost > budget:
+            break
+        budget -= cost
+        recalled.append(text)
+
+    messages = [_summary_message(summary)] if summary else []
+    if recalled:
+        messages.append(_recalled_message(recalled))
+    messages.extend(recent)
+    return messages
+
+
+def _recalled_message(turns: List[str]) -> dict:
+    return {
+        "role": "system",
+        "content": "Фрагменты прошлых разговоров, которые могут относиться к вопросу:\n\n"
+        + "\n\n".join(turns),
+    }
+
+
+def schedule_compaction(user_id: int, user: Session, model: str):
+    """Запускает фоновое сжатие старой части истории, если оно ещё не идёт."""
+    task = _compactions.get(user_id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.create_task(_compact(user_id, user, model))
+    _compactions[user_id] = task
+
+    def _done(t: asyncio.Task):
+        if _compactions.get(user_id) is t:
+            del _compactions[user_id]
+
+    task.add_done_callback(_done)
+
+
+async def _compact(user_id: int, user: Session, model: str):
+    history = user.history
+    keep = HISTORY_KEEP_RECENT
+    if len(history) <= keep:
+        return
+    # Сжимаем всё, кроме последних реплик, плюс предыдущее summary
+    older = history[: len(history) - keep]
+    summary = user.summary
+
+    lines = []
+    if summary:
+        lines.append(f"Ранее: {summary}")
+    for role, content in older:
+        who = "Пользователь" if role == "user" else "Ассистент"
+        lines.append(f"{who}: {content}")
+    messages = [
+        {"role": "system", "content": SUMMARY_INSTRUCTION},
+        {"role": "user", "content": "\n".join(lines)},
+    ]
+
+    try:
+        # Сжатие идёт через общий планировщик, но отдельным "пользователем",
+        # чтобы не блокировать собственные запросы пользователя
+        async with scheduler.slot(f"summary:{user_id}", model):
+            new_summary = await generate_once(model, messages)
+    except (QueueFull, QueueTimeout):
+        logger.info("Сжатие истории пользователя %s отложено: очередь занята", user_id)
+        return
+    if not new_summary:
+        logger.warning("Не удалось сжать историю пользователя %s", user_id)
+        return
+
+    # Пока шло сжатие, историю могли очистить или дополнить — убираем только
+    # те реплики, которые действительно вошли в summary
+    current = user.history
+    if len(current) < len(older) or any(a is not b for a, b in zip(current, older)):
+        return
+    user.summary = new_summary.strip()
+    user.history = current[len(older):]
+    save_user(user_id, user)
+    logger.info(
+        "История пользователя %s сжата: %d реплик -> summary из %d символов",
+        user_id, len(older), len(user.summary),
+    )
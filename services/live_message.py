@@ -0,0 +1,310 @@
+# services/live_message.py
+# "Живое" сообщение для стриминга ответа: куски текста принимаются без ожидания,
+# а правки в Telegram уходят в фоне с заданной частотой.
+# Скорость генерации и частота правок друг от друга не зависят.
+# Длинный ответ разбивается на несколько сообщений: заполненный сегмент
+# «замораживается», и дальше правится только новое сообщение с хвостом ответа.
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from services import metrics, tracing
+from config import (
+    LIVE_EDIT_INTERVAL_SECONDS,
+    TELEGRAM_EDITS_PER_SECOND,
+    TELEGRAM_EDITS_BURST,
+)
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста сообщения Telegram (с запасом)
+MESSAGE_LIMIT = 4000
+
+FENCE = "```"
+# Разрез ищем не раньше этой доли лимита, иначе сегменты получаются слишком короткими
+_MIN_SPLIT_RATIO = 0.5
+
+
+def split_segment(text: str, limit: int = MESSAGE_LIMIT) -> Tuple[int, bool]:
+    """
+    Выбирает, где закончить сегмент длинного текста.
+    Возвращает (позиция разреза, разрез внутри блока кода).
+    Предпочтение: конец абзаца, конец строки, конец предложения, пробел.
+    Если разрез попадает внутрь блока ``` — блок закрывается в этом сегменте
+    и открывается заново в следующем, на это в лимите оставлен запас.
+    """
+    limit -= len(FENCE) + 1
+    if len(text) <= limit:
+        return len(text), False
+    window = text[:limit]
+    lo = int(limit * _MIN_SPLIT_RATIO)
+    cut = -1
+    for sep in ("\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " "):
+        pos = window.rfind(sep, lo)
+        if pos != -1:
+            cut = pos + len(sep)
+            break
+    if cut == -1:
+        cut = limit
+    # Блок кода, открытый до разреза, лучше целиком перенести в следующий сегмент
+    in_code = text.count(FENCE, 0, cut) % 2 == 1
+    if in_code:
+        opening = text.rfind(FENCE, 0, cut)
+        if opening >= lo:
+            return opening, False
+    return cut, in_code
+
+
+class EditBudget:
+    """
+    Общий для всех чатов лимит исходящих правок (token bucket):
+    rate правок в секунду, не больше burst подряд.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+edit_budget = EditBudget(TELEGRAM_EDITS_PER_SECOND, TELEGRAM_EDITS_BURST)
+
+# chat_id -> момент (time.monotonic), до которого Telegram попросил не писать в чат
+_chat_blocked_until: Dict[int, float] = {}
+
+
+class LiveMessage:
+    """
+    Обёртка над сообщением-заглушкой, которое постепенно заполняется ответом.
+    - feed(chunk) только дописывает текст в буфер и будит фоновую задачу;
+    - фоновая задача правит сообщение не чаще раза в interval секунд,
+      пропускает правки без изменений и соблюдает retry_after из ответов 429;
+    - finish() дожидается последней правки с полным текстом;
+    - когда хвост ответа перестаёт помещаться в сообщение, текущий сегмент
+      дописывается до удобной границы и замораживается, а продолжение уходит
+      новым сообщением — так каждая правка несёт только последний сегмент.
+    """
+
+    def __init__(
+        self,
+        message,
+        interval: float = LIVE_EDIT_INTERVAL_SECONDS,
+        budget: EditBudget = edit_budget,
+    ):
+        self.message = message
+        self.interval = interval
+        self.budget = budget
+        self._parts = []
+        self._status: Optional[str] = None
+        # Текст, который сейчас виден в Telegram (чтобы не слать правки без изменений)
+        self._shown: Optional[str] = message.text
+        # Inline-клавиатура под сообщением, пока идёт ответ (например, кнопка ⏹).
+        # Правка без reply_markup убирает клавиатуру, поэтому она передаётся в каждой
+        self.reply_markup = None
+        self._shown_markup = message.reply_markup
+        self._last_edit = 0.0
+        self._dirty = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+        # С какой позиции ответа начинается текущее (последнее) сообщение
+        self._offset = 0
+        # Открывающий ``` для сегмента, начавшегося внутри блока кода
+        self._prefix = ""
+        # Сколько правок реально ушло в Telegram
+        self.edits = 0
+        # Сколько сообщений занял ответ
+        self.segments = 1
+
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def chat_id(self) -> int:
+        return self.message.chat.id
+
+    def _display(self) -> str:
+        # Пока ответа нет — показываем служебный статус (например, место в очереди)
+        if not self._parts:
+            return self._status or ""
+        return self._prefix + self.text[self._offset:]
+
+    async def _roll_over(self):
+        """Замораживает заполненные сегменты и переносит хвост в новые сообщения."""
+        while True:
+            text = self.text
+            tail = self._prefix + text[self._offset:]
+            if len(tail) <= MESSAGE_LIMIT:
+                return
+            cut, in_code = split_segment(tail)
+            frozen = tail[:cut].rstrip()
+            if in_code:
+                frozen += "\n" + FENCE
+            # Сегмент больше не изменится — дожидаемся, пока правка точно дойдёт;
+            # клавиатура переезжает в следующее сообщение
+            await self._edit(frozen, wait_retry=True, markup=None)
+            self._offset += cut - len(self._prefix)
+            self._prefix = FENCE + "\n" if in_code else ""
+            while text[self._offset:self._offset + 1] == "\n":
+                self._offset += 1
+            rest = self._display()[:MESSAGE_LIMIT] or "…"
+            message = await self._send(rest)
+            if message is None:
+                # Новое сообщение отправить не удалось — дальше правим старое,
+                # показывая в нём только хвост ответа
+                return
+            self.message = message
+            self._shown = message.text
+            self._shown_markup = self.reply_markup
+            self.segments += 1
+
+    def status(self, text: str):
+        """
+        Показывает служебный статус, пока не пришёл первый кусок ответа.
+        Правка уходит с той же частотой и в рамках того же лимита, что и ответ.
+        """
+        self._status = text
+        if self._parts:
+            return
+        self._dirty.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def feed(self, chunk: str):
+        """Принимает очередной кусок ответа; никогда не ждёт Telegram."""
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._dirty.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def finish(self, final_text: Optional[str] = None):
+        """
+        Останавливает фоновые правки и показывает окончательный текст
+        (по умолчанию — всё, что накопилось). Клавиатура при этом убирается.
+        """
+        self._closed = True
+        self.reply_markup = None
+        self._dirty.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                logger.exception("Ошибка в фоновой задаче правок")
+        if final_text is not None:
+            await self._edit(final_text, wait_retry=True)
+            return
+        await self._roll_over()
+        await self._edit(self._display(), wait_retry=True)
+
+    async def _run(self):
+        while not self._closed:
+            await self._dirty.wait()
+            if self._closed:
+                return
+            # Выдерживаем интервал между правками одного сообщения
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if self._closed:
+                    return
+            self._dirty.clear()
+            await self._roll_over()
+            await self._edit(self._display())
+
+    async def _send(self, text: str):
+        """Отправляет новое сообщение-сегмент в тот же чат (с учётом 429)."""
+        while True:
+            blocked = _chat_blocked_until.get(self.chat_id, 0.0) - time.monotonic()
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+            await self.budget.acquire()
+            self._last_edit = time.monotonic()
+            try:
+                with tracing.span("telegram.send", chars=len(text)):
+                    return await self.message.answer(text, reply_markup=self.reply_markup)
+            except TelegramRetryAfter as e:
+                metrics.telegram_429.inc()
+                logger.warning("Telegram 429 в чате %s, ждём %s с", self.chat_id, e.retry_after)
+                _chat_blocked_until[self.chat_id] = time.monotonic() + e.retry_after
+            except Exception:
+                logger.exception("Не удалось отправить продолжение ответа")
+                return None
+
+    async def _edit(self, text: str, wait_retry: bool = False, markup=...):
+        text = text[:MESSAGE_LIMIT]
+        if markup is ...:
+            markup = self.reply_markup
+        if not text or (text == self._shown and markup is self._shown_markup):
+            return
+        # Правка одной клавиатуры (например, появилась кнопка ⏹) не должна
+        # отодвигать показ первого куска ответа на целый интервал
+        markup_only = text == self._shown
+        last_edit = self._last_edit
+        while True:
+            blocked = _chat_blocked_until.get(self.chat_id, 0.0) - time.monotonic()
+            if blocked <= 0:
+                _chat_blocked_until.pop(self.chat_id, None)
+            else:
+                if not wait_retry:
+                    # Промежуточную правку просто пропускаем — её заменит следующая
+                    self._dirty.set()
+                    self._last_edit = time.monotonic() + blocked - self.interval
+                    return
+                await asyncio.sleep(blocked)
+            with tracing.span("telegram.edit_budget"):
+                await self.budget.acquire()
+            self._last_edit = time.monotonic()
+            try:
+                with tracing.span("telegram.edit", chars=len(text)):
+                    await self.message.edit_text(text, reply_markup=markup)
+                metrics.edit_seconds.observe(time.monotonic() - self._last_edit)
+                if markup_only:
+                    self._last_edit = last_edit
+                self.edits += 1
+                self._shown = text
+                self._shown_markup = markup
+                return
+            except TelegramRetryAfter as e:
+                metrics.telegram_429.inc()
+                logger.warning("Telegram 429 в чате %s, ждём %s с", self.chat_id, e.retry_after)
+                _chat_blocked_until[self.chat_id] = time.monotonic() + e.retry_after
+                if not wait_retry:
+                    self._dirty.set()
+                    return
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self._shown = text
+                    self._shown_markup = markup
+                else:
+                    logger.warning("Не удалось обновить сообщение: %s", e)
+                return
+            except Exception:
+                logger.exception("Не удалось обновить сообщение")
+                return
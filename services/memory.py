@@ -0,0 +1,433 @@
+# services/memory.py
+# Долговременная память на эмбеддингах.
+# Реплики, выпавшие из окна последних ходов, не удаляются, а переезжают в индекс
+# пользователя: их эмбеддинги считаются пачками в фоне через /api/embed
+# и хранятся в NumPy-матрице с нормированными строками. На диске у пользователя
+# два файла в MEMORY_DIR, оба только дописываются: векторы (float16 подряд, в начале —
+# размерность) и тексты (JSON-строка в UTF-8 на строку файла).
+# Реплика уходит из истории только после того, как её текст записан в журнал
+# <id>.pending.jsonl; журнал очищается, когда реплика проиндексирована, а при
+# запуске недоделанное из журналов снова ставится в очередь.
+# На запросе считается один эмбеддинг вопроса, и косинусное сходство со всеми
+# репликами — одно умножение матрицы на вектор; в запрос идут top-k похожих.
+# Включается флагом MEMORY_ENABLED.
+
+import asyncio
+import json
+import logging
+import os
+import struct
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    MEMORY_ENABLED,
+    MEMORY_EMBED_MODEL,
+    MEMORY_DIR,
+    MEMORY_TOP_K,
+    MEMORY_MIN_SCORE,
+    MEMORY_RECENT_TURNS,
+    MEMORY_EMBED_BATCH,
+    MEMORY_FLUSH_INTERVAL_SECONDS,
+    MEMORY_MAX_LOADED_USERS,
+    MEMORY_MAX_PENDING,
+)
+from services.ollama_client import embed
+from storage import Session, Turn
+
+logger = logging.getLogger(__name__)
+
+# Журнал реплик пользователя, ждущих эмбеддинга
+_JOURNAL_SUFFIX = ".pending.jsonl"
+
+# Заголовок файла векторов: размерность (uint32, little-endian)
+_HEADER = struct.Struct("<I")
+
+
+def _turn_text(turns: List[Turn]) -> str:
+    lines = []
+    for role, content in turns:
+        who = "Пользователь" if role == "user" else "Ассистент"
+        lines.append(f"{who}: {content}")
+    return "\n".join(lines)
+
+
+def split_turns(history: List[Turn]) -> List[str]:
+    """Склеивает реплики в ходы: вопрос пользователя вместе с ответами на него."""
+    turns, current = [], []
+    for turn in history:
+        if turn[0] == "user" and current:
+            turns.append(_turn_text(current))
+            current = []
+        current.append(turn)
+    if current:
+        turns.append(_turn_text(current))
+    return turns
+
+
+class _UserIndex:
+    __slots__ = ("vectors", "texts")
+
+    def __init__(self, vectors, texts: List[str]):
+        # vectors: (n, dim) float32, строки нормированы; texts[i] — текст i-й строки
+        self.vectors = vectors
+        self.texts = texts
+
+
+class MemoryIndex:
+    def __init__(
+        self,
+        enabled: bool,
+        model: str,
+        directory: str,
+        top_k: int,
+        min_score: float,
+        recent_turns: int,
+        batch: int,
+        flush_interval: float,
+        max_loaded: int,
+        max_pending: int,
+    ):
+        self.enabled = enabled
+        self.model = model
+        self.directory = directory
+        self.top_k = top_k
+        self.min_score = min_score
+        self.recent_turns = recent_turns
+        self.batch = max(1, batch)
+        self.flush_interval = flush_interval
+        self.max_loaded = max(1, max_loaded)
+        self.max_pending = max_pending
+        self._pending_full = False
+        self._loaded: "OrderedDict[int, _UserIndex]" = OrderedDict()
+        # Реплики, ждущие эмбеддинга: (user_id, поколение памяти, текст хода)
+        self._pending: List[Tuple[int, int, str]] = []
+        # user_id -> поколение: растёт при forget(), чтобы пачка, посчитанная
+        # до очистки, не записала старые реплики обратно
+        self._epochs: Dict[int, int] = {}
+        # Чтение/запись файла пользователя не должны идти одновременно
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            logger.warning("numpy не установлен — долговременная память отключена")
+            self.enabled = False
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._restore_pending()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+        logger.info("Долговременная память включена: %s, %s", self.model, self.directory)
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Последняя попытка проиндексировать накопившееся; что не успели —
+        # останется в журналах и проиндексируется после перезапуска
+        while self._pending:
+            if not await self._flush():
+                logger.warning(
+                    "Не проиндексировано реплик при остановке: %d (сохранены в журнале)",
+                    len(self._pending),
+                )
+                break
+
+    # ---------- индекс на диске ----------
+
+    def _paths(self, user_id: int) -> Tuple[str, str]:
+        base = os.path.join(self.directory, str(user_id))
+        return base + ".vec", base + ".jsonl"
+
+    def _journal_path(self, user_id: int) -> str:
+        return os.path.join(self.directory, f"{user_id}{_JOURNAL_SUFFIX}")
+
+    def _journal_append(self, user_id: int, texts: List[str]):
+        with open(self._journal_path(user_id), "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(text, ensure_ascii=False) + "\n" for text in texts)
+
+    def _journal_rewrite(self, user_id: int):
+        """Оставляет в журнале пользователя только ещё не проиндексированные реплики."""
+        epoch = self._epochs.get(user_id, 0)
+        texts = [t for uid, e, t in self._pending if uid == user_id and e == epoch]
+        path = self._journal_path(user_id)
+        if not texts:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(text, ensure_ascii=False) + "\n" for text in texts)
+        os.replace(tmp, path)
+
+    def _restore_pending(self):
+        """Ставит в очередь реплики из журналов, не проиндексированные до остановки."""
+        for name in os.listdir(self.directory):
+            if not name.endswith(_JOURNAL_SUFFIX):
+                continue
+            try:
+                user_id = int(name[: -len(_JOURNAL_SUFFIX)])
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            self._pending.append((user_id, 0, json.loads(line)))
+                        except ValueError:
+                            break
+            except (ValueError, OSError):
+                logger.exception("Не удалось прочитать журнал памяти %s", name)
+        if self._pending:
+            logger.info("Из журналов памяти восстановлено реплик: %d", len(self._pending))
+
+    def _read(self, user_id: int) -> _UserIndex:
+        import numpy as np
+
+        vec_path, text_path = self._paths(user_id)
+        try:
+            with open(vec_path, "rb") as f:
+                (dim,) = _HEADER.unpack(f.read(_HEADER.size))
+                # На диске float16 (вдвое компактнее), считаем во float32 — так работает BLAS
+                data = np.fromfile(f, dtype="<f2")
+            texts = []
+            with open(text_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        texts.append(json.loads(line))
+                    except ValueError:
+                        # Оборванная последняя строка
+                        break
+        except FileNotFoundError:
+            return _UserIndex(None, [])
+        except Exception:
+            logger.exception("Не удалось прочитать индекс памяти пользователя %s", user_id)
+            return _UserIndex(None, [])
+
+        rows = len(data) // dim if dim else 0
+        n = min(rows, len(texts))
+        index = _UserIndex(data[: n * dim].reshape(n, dim).astype(np.float32), texts[:n])
+        if n != rows or n != len(texts) or len(data) != rows * dim:
+            # Запись оборвалась на середине — выравниваем файлы, иначе следующие
+            # дописанные векторы и тексты съедут относительно друг друга
+            logger.warning("Индекс памяти пользователя %s восстановлен (%d записей)", user_id, n)
+            self._append(user_id, index.vectors, index.texts, rewrite=True)
+        return index
+
+    def _append(self, user_id: int, vectors, texts: List[str], rewrite: bool = False):
+        """Дописывает записи в файлы пользователя; rewrite — записать файлы заново."""
+        vec_path, text_path = self._paths(user_id)
+        mode = "w" if rewrite else "a"
+        with open(vec_path, mode + "b") as f:
+            if rewrite:
+                f.write(_HEADER.pack(vectors.shape[1]))
+            f.write(vectors.astype("<f2").tobytes())
+        with open(text_path, mode, encoding="utf-8") as f:
+            f.writelines(json.dumps(text, ensure_ascii=False) + "\n" for text in texts)
+
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def _load(self, user_id: int) -> _UserIndex:
+        index = self._loaded.get(user_id)
+        if index is not None:
+            self._loaded.move_to_end(user_id)
+            return index
+        epoch = self._epochs.get(user_id, 0)
+        index = await asyncio.to_thread(self._read, user_id)
+        if epoch != self._epochs.get(user_id, 0):
+            # Пока читали, память стёрли — прочитанное уже неактуально
+            return _UserIndex(None, [])
+        # Пока читали, индекс могли загрузить параллельно
+        existing = self._loaded.get(user_id)
+        if existing is not None:
+            return existing
+        self._loaded[user_id] = index
+        while len(self._loaded) > self.max_loaded:
+            # Всё уже на диске — из памяти можно просто выбросить
+            self._loaded.popitem(last=False)
+        return index
+
+    # ---------- запись ----------
+
+    def remember(self, user_id: int, user: Session):
+        """
+        Переносит реплики старше последних recent_turns ходов из user.history
+        в индекс (эмбеддинги досчитаются в фоне). Вызывается перед save_user.
+        """
+        if not self.enabled:
+            return
+        history = user.history
+        # Начало окна последних ходов
+        start, turns = len(history), 0
+        while start > 0:
+            start -= 1
+            if history[start][0] == "user":
+                turns += 1
+                if turns == self.recent_turns:
+                    break
+        if start <= 0:
+            return
+        texts = split_turns(history[:start])
+        if len(self._pending) + len(texts) > self.max_pending:
+            # Эмбеддинги давно не считаются — реплики пока остаются в истории
+            if not self._pending_full:
+                logger.warning(
+                    "Очередь долговременной памяти заполнена (%d из %d) — модель %s недоступна?",
+                    len(self._pending), self.max_pending, self.model,
+                )
+                self._pending_full = True
+            return
+        self._pending_full = False
+        try:
+            self._journal_append(user_id, texts)
+        except OSError:
+            logger.exception("Не удалось записать журнал памяти пользователя %s", user_id)
+            return
+        epoch = self._epochs.get(user_id, 0)
+        for text in texts:
+            self._pending.append((user_id, epoch, text))
+        # Из истории — только после того, как тексты на диске
+        user.history = history[start:]
+        if len(self._pending) >= self.batch:
+            self._wakeup.set()
+
+    async def forget(self, user_id: int):
+        """Стирает долговременную память пользователя (вместе с очисткой истории)."""
+        if not self.enabled:
+            return
+        # Новое поколение сразу: идущая запись увидит его и ничего не допишет
+        self._epochs[user_id] = self._epochs.get(user_id, 0) + 1
+        self._pending = [item for item in self._pending if item[0] != user_id]
+        self._loaded.pop(user_id, None)
+        # Файлы удаляем под тем же замком, под которым их дописывает _flush
+        async with self._lock(user_id):
+            self._loaded.pop(user_id, None)
+            for path in (*self._paths(user_id), self._journal_path(user_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._pending:
+                if not await self._flush():
+                    # Ollama недоступна — попробуем в следующий раз
+                    break
+
+    async def _flush(self) -> bool:
+        """Считает эмбеддинги одной пачки реплик (всех пользователей сразу) и дописывает индексы."""
+        import numpy as np
+
+        batch = self._pending[: self.batch]
+        del self._pending[: len(batch)]
+        vectors = await embed(self.model, [text for _, _, text in batch])
+        if vectors is None:
+            # Возвращаем пачку в начало очереди, кроме уже забытых реплик
+            self._pending[:0] = [b for b in batch if b[1] == self._epochs.get(b[0], 0)]
+            return False
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.maximum(norms, 1e-12)
+
+        rows: Dict[int, List[int]] = {}
+        for i, (user_id, epoch, _) in enumerate(batch):
+            if epoch == self._epochs.get(user_id, 0):
+                rows.setdefault(user_id, []).append(i)
+        for user_id, idx in rows.items():
+            async with self._lock(user_id):
+                if batch[idx[0]][1] != self._epochs.get(user_id, 0):
+                    continue
+                index = await self._load(user_id)
+                # Пока ждали замок и читали индекс, память могли стереть
+                if batch[idx[0]][1] != self._epochs.get(user_id, 0):
+                    continue
+                new = matrix[idx]
+                texts = [batch[i][2] for i in idx]
+                rewrite = index.vectors is None or index.vectors.shape[1] != new.shape[1]
+                if rewrite:
+                    if index.vectors is not None:
+                        # Сменилась модель эмбеддингов — старые векторы несравнимы
+                        logger.warning("Индекс памяти пользователя %s пересоздан", user_id)
+                    index.vectors, index.texts = new, []
+                else:
+                    index.vectors = np.concatenate([index.vectors, new])
+                index.texts.extend(texts)
+                # На диск — только новые записи, без перезаписи всего индекса
+                try:
+                    await asyncio.to_thread(self._append, user_id, new, texts, rewrite)
+                except OSError:
+                    logger.exception("Не удалось записать индекс памяти пользователя %s", user_id)
+                    # Индекс в памяти разошёлся с диском — перечитаем его заново,
+                    # а реплики вернём в очередь (в журнале они остались)
+                    self._loaded.pop(user_id, None)
+                    self._pending[:0] = [batch[i] for i in idx]
+                    continue
+                self._journal_rewrite(user_id)
+        return True
+
+    # ---------- поиск ----------
+
+    async def recall(self, user_id: int, query: str) -> List[str]:
+        """Прошлые ходы, самые похожие на запрос (по убыванию сходства)."""
+        if not self.enabled or not query.strip():
+            return []
+        index = await self._load(user_id)
+        if index.vectors is None or not len(index.texts):
+            return []
+        vectors = await embed(self.model, [query])
+        if vectors is None:
+            return []
+
+        import numpy as np
+
+        q = np.asarray(vectors[0], dtype=np.float32)
+        if q.shape[0] != index.vectors.shape[1]:
+            return []
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        scores = index.vectors @ q
+        k = min(self.top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [index.texts[i] for i in top if scores[i] >= self.min_score]
+
+    def stats(self) -> dict:
+        return {
+            "loaded_users": len(self._loaded),
+            "pending": len(self._pending),
+            "vectors": sum(len(i.texts) for i in self._loaded.values()),
+        }
+
+
+memory = MemoryIndex(
+    enabled=MEMORY_ENABLED,
+    model=MEMORY_EMBED_MODEL,
+    directory=MEMORY_DIR,
+    top_k=MEMORY_TOP_K,
+    min_score=MEMORY_MIN_SCORE,
+    recent_turns=MEMORY_RECENT_TURNS,
+    batch=MEMORY_EMBED_BATCH,
+    flush_interval=MEMORY_FLUSH_INTERVAL_SECONDS,
+    max_loaded=MEMORY_MAX_LOADED_USERS,
+    max_pending=MEMORY_MAX_PENDING,
+)
@@ -0,0 +1,207 @@
+# services/metrics.py
+# Метрики генераций в формате Prometheus и локальный HTTP-эндпоинт /metrics.
+# Статистика Ollama из финального события стрима (eval_count, eval_duration, ...)
+# дополняется нашими замерами: ожидание в очереди, время до первого токена,
+# правки сообщений в Telegram и длина ответа.
+
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+# Все зарегистрированные метрики в порядке объявления
+_registry: List["_Metric"] = []
+
+
+def _fmt_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, v in self._values.items():
+            lines.append(f"{self.name}{_fmt_labels(self.labels, key)} {v}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение считывается функцией в момент запроса /metrics."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        try:
+            lines.append(f"{self.name} {float(self.fn())}")
+        except Exception:
+            logger.debug("Не удалось прочитать %s", self.name, exc_info=True)
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ("model",)
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счётчики по корзинам..., сумма, количество]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        n = len(self.buckets)
+        for key, series in self._series.items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += series[i]
+                le = _fmt_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            inf = _fmt_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {series[n + 1]}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {series[n]}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {series[n + 1]}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+SECONDS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+TOKENS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+
+queue_wait = Histogram("hubert_queue_wait_seconds", "Ожидание в очереди генераций", SECONDS)
+time_to_first_token = Histogram(
+    "hubert_time_to_first_token_seconds", "От запроса до первого куска ответа", SECONDS
+)
+generation_seconds = Histogram(
+    "hubert_generation_seconds", "Полное время генерации ответа", SECONDS
+)
+load_seconds = Histogram("hubert_ollama_load_seconds", "Загрузка модели (load_duration)", SECONDS)
+prompt_eval_seconds = Histogram(
+    "hubert_ollama_prompt_eval_seconds", "Обработка промпта (prompt_eval_duration)", SECONDS
+)
+eval_seconds = Histogram("hubert_ollama_eval_seconds", "Генерация токенов (eval_duration)", SECONDS)
+prompt_tokens = Histogram("hubert_ollama_prompt_tokens", "Токенов в промпте (prompt_eval_count)", TOKENS)
+eval_tokens = Histogram("hubert_ollama_eval_tokens", "Сгенерировано токенов (eval_count)", TOKENS)
+tokens_per_second = Histogram(
+    "hubert_ollama_tokens_per_second", "Скорость генерации", (1, 5, 10, 20, 40, 80, 160)
+)
+reply_chars = Histogram(
+    "hubert_reply_chars", "Длина ответа в символах", (100, 500, 1000, 2000, 4000, 8000, 16000)
+)
+edits_per_reply = Histogram(
+    "hubert_telegram_edits_per_reply", "Правок сообщения на один ответ", (1, 2, 5, 10, 20, 50, 100)
+)
+edit_seconds = Histogram(
+    "hubert_telegram_edit_seconds", "Время одного запроса editMessageText",
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5), labels=(),
+)
+telegram_429 = Counter("hubert_telegram_429_total", "Ответов 429 от Telegram")
+generations = Counter("hubert_generations_total", "Генераций по исходу", ("model", "outcome"))
+response_cache_requests = Counter(
+    "hubert_response_cache_requests_total",
+    "Запросов через кэш ответов: hit — из кэша, join — к идущей генерации, miss — новая генерация",
+    ("result",),
+)
+governor_adjustments = Counter(
+    "hubert_governor_adjustments_total", "Изменений запросов регулятором нагрузки", ("kind",)
+)
+governor_level_changes = Counter(
+    "hubert_governor_level_changes_total", "Смен уровня регулятора нагрузки", ("direction",)
+)
+
+
+def observe_ollama_stats(model: str, stats: Optional[dict]):
+    """Раскладывает статистику финального события Ollama по гистограммам."""
+    if not stats:
+        return
+    ns = 1e-9
+    if "load_duration" in stats:
+        load_seconds.observe(stats["load_duration"] * ns, model=model)
+    if "prompt_eval_duration" in stats:
+        prompt_eval_seconds.observe(stats["prompt_eval_duration"] * ns, model=model)
+    if "prompt_eval_count" in stats:
+        prompt_tokens.observe(stats["prompt_eval_count"], model=model)
+    if "eval_count" in stats:
+        eval_tokens.observe(stats["eval_count"], model=model)
+    if "eval_duration" in stats:
+        eval_seconds.observe(stats["eval_duration"] * ns, model=model)
+        if stats.get("eval_count") and stats["eval_duration"]:
+            tokens_per_second.observe(
+                stats["eval_count"] / (stats["eval_duration"] * ns), model=model
+            )
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Поднимает HTTP-сервер с /metrics; вернуть runner нужно для остановки."""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,98 @@
+# services/model_catalog.py
+# Кэш списка моделей Ollama: TTL, обновление "stale-while-revalidate"
+# и объединение одновременных запросов в один поход к /api/tags.
+# Когда пул узлов замечает pull/delete моделей, кэш сбрасывается сразу.
+
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import MODEL_CATALOG_TTL_SECONDS, MODEL_CATALOG_STALE_SECONDS
+from services.ollama_client import get_models, pool
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCatalog:
+    """
+    Кэшированный список моделей.
+    - Пока данные моложе TTL — отдаются из памяти без запросов к Ollama.
+    - Если TTL истёк, но данные ещё не старше STALE — отдаются старые данные,
+      а обновление запускается в фоне.
+    - Одновременные обновления объединяются в одну задачу (single-flight).
+    Каждое изменение списка увеличивает version — по нему кэшируются клавиатуры.
+    """
+
+    def __init__(self, ttl: float, stale: float):
+        self.ttl = ttl
+        self.stale = stale
+        self.models: List[str] = []
+        self.version = 0
+        self._fetched_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        # (version, page) -> готовая отрисованная страница
+        self._pages: Dict[Tuple[int, int], object] = {}
+
+    def _age(self) -> float:
+        return time.monotonic() - self._fetched_at
+
+    async def get(self) -> List[str]:
+        """
+        Возвращает список моделей. Пустой список — если Ollama недоступна
+        и в кэше ничего нет.
+        """
+        if self.models:
+            age = self._age()
+            if age < self.ttl:
+                return self.models
+            if age < self.ttl + self.stale:
+                self._start_refresh()
+                return self.models
+        # shield — чтобы отмена одного ожидающего не отменяла общий запрос
+        return await asyncio.shield(self._start_refresh())
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self) -> List[str]:
+        models = await get_models()
+        if not models:
+            # Ошибку не кэшируем: оставляем прежний список, если он был
+            logger.warning("Не удалось обновить список моделей, используется кэш")
+            return self.models
+        if models != self.models:
+            self.models = models
+            self.version += 1
+            self._pages.clear()
+        self._fetched_at = time.monotonic()
+        return self.models
+
+    def invalidate(self):
+        """
+        Сбрасывает кэш. Вызывается после pull/delete моделей в Ollama,
+        чтобы следующий запрос сразу получил актуальный список.
+        """
+        self._fetched_at = 0.0
+        self.models = []
+        self.version += 1
+        self._pages.clear()
+
+    def page(self, page: int, build: Callable[[List[str], int], object]):
+        """
+        Возвращает отрисованную страницу для текущей версии списка,
+        вызывая build(models, page) только при первом обращении.
+        """
+        key = (self.version, page)
+        cached = self._pages.get(key)
+        if cached is None:
+            cached = build(self.models, page)
+            self._pages[key] = cached
+        return cached
+
+
+catalog = ModelCatalog(MODEL_CATALOG_TTL_SECONDS, MODEL_CATALOG_STALE_SECONDS)
+# Пул узлов и так перечитывает /api/tags при каждой проверке — по нему и узнаём о pull/delete
+pool.on_models_changed.append(catalog.invalidate)
@@ -0,0 +1,114 @@
+# services/ndjson.py
+# Потоковый декодер NDJSON-ответов Ollama.
+# Куски из сети режутся на строки независимо от границ чанков, строки
+# разбираются в типизированные события: кусок текста, завершение со статистикой
+# или ошибка. Если установлен orjson — используется он (заметно быстрее json).
+
+import json
+import logging
+from dataclasses import dataclass
+from typing import List, Union
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    _loads = json.loads
+    JSON_BACKEND = "json"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class ContentDelta:
+    """Очередной кусок текста ответа."""
+    text: str
+
+
+@dataclass(slots=True)
+class Done:
+    """Финальное событие стрима; stats — всё, что Ollama прислала кроме message."""
+    stats: dict
+
+
+@dataclass(slots=True)
+class StreamError:
+    """Ошибка, присланная самой Ollama внутри стрима."""
+    message: str
+
+
+StreamEvent = Union[ContentDelta, Done, StreamError]
+
+
+def parse_event(obj) -> List[StreamEvent]:
+    """Превращает один разобранный JSON-объект в события (обычно одно)."""
+    if not isinstance(obj, dict):
+        return []
+    if "error" in obj:
+        return [StreamError(str(obj["error"]))]
+
+    events: List[StreamEvent] = []
+    message = obj.get("message")
+    if isinstance(message, dict):
+        content = message.get("content")
+    else:
+        # /api/generate присылает текст в поле "response"
+        content = obj.get("response")
+    if content:
+        events.append(ContentDelta(str(content)))
+    if obj.get("done"):
+        stats = {k: v for k, v in obj.items() if k != "message"}
+        events.append(Done(stats))
+    return events
+
+
+class NDJSONDecoder:
+    """
+    Инкрементальный декодер: feed() принимает произвольные куски байтов
+    и возвращает события для всех строк, завершённых к этому моменту.
+    Незавершённый хвост остаётся в переиспользуемом буфере до следующего куска.
+    """
+
+    __slots__ = ("_buf",)
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data: bytes) -> List[StreamEvent]:
+        buf = self._buf
+        buf += data
+        end = buf.rfind(b"\n")
+        if end < 0:
+            return []
+        events: List[StreamEvent] = []
+        start = 0
+        while start <= end:
+            nl = buf.find(b"\n", start)
+            line = bytes(buf[start:nl])
+            start = nl + 1
+            if line.strip():
+                events.extend(self._parse(line))
+        del buf[: end + 1]
+        return events
+
+    def close(self) -> List[StreamEvent]:
+        """Разбирает остаток буфера (последняя строка может прийти без \\n)."""
+        line = bytes(self._buf)
+        self._buf.clear()
+        if not line.strip():
+            return []
+        return self._parse(line)
+
+    @staticmethod
+    def _parse(line: bytes) -> List[StreamEvent]:
+        try:
+            obj = _loads(line)
+        except ValueError:
+            # orjson.JSONDecodeError и json.JSONDecodeError — наследники ValueError
+            logger.warning("Пропущена невалидная строка стрима: %r", line[:200])
+            return []
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("stream event: %r", obj)
+        return parse_event(obj)
@@ -1,76 +1,382 @@
 # services/ollama_client.py
 # Модуль для общения с Ollama API: получение списка моделей и стриминг-чат.
+# Поддерживается несколько серверов Ollama с выбором узла и переключением при сбоях.
 # Здесь добавлены таймауты и защита от ошибок, чтобы бот не "вис" при проблемах сети.
+# Все запросы идут через один долгоживущий клиент с пулом keep-alive соединений.
 
 import aiohttp
 import asyncio
-import json
-from typing import List, Callable, Awaitable
+import logging
+import time
+from typing import List, Callable, Awaitable, Optional, Set
 
-from config import OLLAMA_URL, HTTP_TIMEOUT_SECONDS
+from config import (
+    OLLAMA_URLS,
+    OLLAMA_HEALTH_INTERVAL_SECONDS,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_PINNED_MODELS,
+    OLLAMA_POOL_LIMIT,
+    OLLAMA_POOL_LIMIT_PER_HOST,
+    OLLAMA_KEEPALIVE_SECONDS,
+    OLLAMA_CONNECT_TIMEOUT,
+    OLLAMA_READ_TIMEOUT,
+    OLLAMA_LOAD_TIMEOUT,
+    MODEL_CONTEXT_TOKENS,
+)
+from services.ndjson import NDJSONDecoder, ContentDelta, Done, StreamError
+from services import tracing
+
+logger = logging.getLogger(__name__)
 
 # Конфигурация таймаута для aiohttp
-HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_connect=10, sock_read=60)
+HTTP_TIMEOUT = aiohttp.ClientTimeout(
+    total=None,
+    connect=OLLAMA_CONNECT_TIMEOUT,
+    sock_connect=OLLAMA_CONNECT_TIMEOUT,
+    sock_read=OLLAMA_READ_TIMEOUT,
+)
+# Для запросов, которым может понадобиться загрузить модель в память
+LOAD_TIMEOUT = aiohttp.ClientTimeout(
+    total=None,
+    connect=OLLAMA_CONNECT_TIMEOUT,
+    sock_connect=OLLAMA_CONNECT_TIMEOUT,
+    sock_read=OLLAMA_LOAD_TIMEOUT,
+)
 
 
-async def get_models() -> List[str]:
+def _timeout_for(node, model: str) -> aiohttp.ClientTimeout:
+    """Если модель на узле ещё не в памяти, первый байт придёт только после загрузки."""
+    return HTTP_TIMEOUT if model in node.loaded else LOAD_TIMEOUT
+
+
+def _is_connect_error(e: BaseException) -> bool:
     """
-    Возвращает список имён моделей, доступных в Ollama.
-    В случае ошибки возвращает пустой список (без выбрасывания исключения).
+    Узел недоступен: не удалось подключиться или соединение оборвалось.
+    Таймаут чтения сюда не относится — узел жив, просто занят (например, грузит модель).
     """
-    url = f"{OLLAMA_URL}/api/tags"
-    try:
-        async with aiohttp.ClientSession(timeout=HTTP_TIMEOUT) as session:
-            async with session.get(url) as resp:
-                # Если сервис вернул не 200 — считаем, что список недоступен
+    if isinstance(e, aiohttp.ConnectionTimeoutError):
+        return True
+    return isinstance(e, aiohttp.ClientConnectionError) and not isinstance(e, asyncio.TimeoutError)
+
+
+class OllamaClient:
+    """
+    Общий HTTP-клиент к Ollama: одна ClientSession с ограниченным пулом
+    keep-alive соединений. Создаётся при старте Dispatcher и закрывается при остановке.
+    Ведёт счётчики новых и переиспользованных соединений для статистики пула.
+    """
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    async def start(self):
+        """Создаёт сессию и пул соединений (повторный вызов ничего не делает)."""
+        if self._session is None or self._session.closed:
+            self._create()
+
+    def _create(self):
+        self._connector = aiohttp.TCPConnector(
+            limit=OLLAMA_POOL_LIMIT,
+            limit_per_host=OLLAMA_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=OLLAMA_KEEPALIVE_SECONDS,
+        )
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_create)
+        trace.on_connection_reuseconn.append(self._on_reuse)
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            timeout=HTTP_TIMEOUT,
+            trace_configs=[trace],
+        )
+
+    async def close(self):
+        """Закрывает сессию и все соединения пула."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Текущая сессия. Если клиент не был запущен через start() (например, модуль
+        используется вне бота), сессия создаётся лениво при первом обращении.
+        """
+        if self._session is None or self._session.closed:
+            self._create()
+        return self._session
+
+    async def _on_create(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+
+    def stats(self) -> dict:
+        """
+        Статистика пула: занятые и простаивающие соединения, сколько соединений
+        было открыто и переиспользовано, доля переиспользования.
+        """
+        in_use = 0
+        idle = 0
+        if self._connector is not None and not self._connector.closed:
+            in_use = len(getattr(self._connector, "_acquired", ()))
+            conns = getattr(self._connector, "_conns", {})
+            idle = sum(len(v) for v in conns.values())
+        total = self.connections_created + self.connections_reused
+        return {
+            "in_use": in_use,
+            "idle": idle,
+            "created": self.connections_created,
+            "reused": self.connections_reused,
+            "reuse_ratio": (self.connections_reused / total) if total else 0.0,
+        }
+
+
+# Единственный клиент на процесс
+client = OllamaClient()
+
+
+def _parse_models(data) -> List[str]:
+    """Достаёт имена моделей из ответа /api/tags (поддерживает несколько форматов)."""
+    models = []
+    # Ollama может вернуть {"models": [{"name": "..."} , ...]} или похожую структуру
+    if isinstance(data, dict):
+        for k in ("models", "tags", "data"):
+            items = data.get(k)
+            if items and isinstance(items, list):
+                data = items
+                break
+    # дальше — список строк или словарей с ключом "name"
+    if isinstance(data, list):
+        for it in data:
+            if isinstance(it, str):
+                models.append(it)
+            elif isinstance(it, dict):
+                name = it.get("name") or it.get("model") or it.get("id")
+                if name:
+                    models.append(str(name))
+    return models
+
+
+class OllamaNode:
+    """Один сервер Ollama: что на нём есть, что загружено и насколько он занят."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        # До первой проверки считаем узел живым, чтобы не блокировать старт
+        self.healthy = True
+        self.checked = False
+        self.models: Set[str] = set()
+        self.loaded: Set[str] = set()
+        self.in_flight = 0
+
+    def __repr__(self):
+        return f"OllamaNode({self.url}, healthy={self.healthy}, in_flight={self.in_flight})"
+
+
+class OllamaPool:
+    """
+    Набор серверов Ollama с периодической проверкой здоровья.
+    По /api/tags узнаёт, какие модели есть на узле, по /api/ps — какие загружены
+    в память. Запрос отправляется на наименее загруженный узел, где модель уже
+    прогрета; если такого нет — туда, где она хотя бы скачана.
+    """
+
+    def __init__(self, urls: List[str], interval: float):
+        self.nodes = [OllamaNode(u) for u in urls]
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        # Вызываются, когда на узле появились или пропали модели (pull/delete)
+        self.on_models_changed: List[Callable[[], None]] = []
+
+    async def start(self):
+        await self.check_all()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check_all()
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(n) for n in self.nodes))
+
+    async def check(self, node: OllamaNode):
+        try:
+            async with client.session.get(f"{node.url}/api/tags") as resp:
+                resp.raise_for_status()
+                models = set(_parse_models(await resp.json()))
+            changed = node.checked and models != node.models
+            node.models = models
+            async with client.session.get(f"{node.url}/api/ps") as resp:
+                # /api/ps есть не во всех версиях Ollama — тогда просто не знаем
+                if resp.status == 200:
+                    node.loaded = set(_parse_models(await resp.json()))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if node.healthy:
+                logger.warning("Ollama %s недоступна: %s", node.url, e)
+            node.healthy = False
+            node.checked = True
+            return
+        if not node.healthy:
+            logger.info("Ollama %s снова доступна", node.url)
+        node.healthy = True
+        node.checked = True
+        if changed:
+            logger.info("Список моделей на %s изменился", node.url)
+            for callback in self.on_models_changed:
+                callback()
+
+    def mark_failed(self, node: OllamaNode):
+        node.healthy = False
+        logger.warning("Ollama %s не отвечает, переключаемся на другой узел", node.url)
+
+    def is_loaded(self, model: str) -> bool:
+        """Загружена ли модель в память хотя бы на одном живом узле."""
+        return any(model in n.loaded for n in self.healthy_nodes())
+
+    def healthy_nodes(self) -> List[OllamaNode]:
+        return [n for n in self.nodes if n.healthy]
+
+    def candidates(self, model: str) -> List[OllamaNode]:
+        """
+        Узлы в порядке предпочтения для модели: сначала с загруженной моделью,
+        потом со скачанной, потом ещё не проверенные; внутри группы — по загрузке.
+        Если живых узлов нет — пробуем все (вдруг кто-то уже поднялся).
+        """
+        def rank(n: OllamaNode):
+            if model in n.loaded:
+                group = 0
+            elif model in n.models:
+                group = 1
+            elif not n.checked:
+                group = 2
+            else:
+                group = 3
+            return (group, n.in_flight)
+
+        nodes = self.healthy_nodes() or list(self.nodes)
+        ranked = sorted(nodes, key=rank)
+        # Узлы, где модели точно нет, оставляем только если других вариантов нет
+        useful = [n for n in ranked if rank(n)[0] < 3]
+        return useful or ranked
+
+
+# Все узлы Ollama этого процесса
+pool = OllamaPool(OLLAMA_URLS, OLLAMA_HEALTH_INTERVAL_SECONDS)
+
+
+def keep_alive_for(model: str):
+    """Сколько Ollama держать модель в памяти после запроса: закреплённые — всегда."""
+    return -1 if model in OLLAMA_PINNED_MODELS else OLLAMA_KEEP_ALIVE
+
+
+def context_size(model: str) -> int:
+    """Размер контекста модели в токенах (MODEL_CONTEXT_TOKENS)."""
+    return MODEL_CONTEXT_TOKENS.get(model, MODEL_CONTEXT_TOKENS["*"])
+
+
+def model_options(model: str, options: Optional[dict] = None) -> dict:
+    """
+    Параметры Ollama для запроса к модели. num_ctx передаётся всегда и всегда один
+    и тот же: без него Ollama берёт свой размер контекста по умолчанию и молча
+    обрезает начало промпта, а с другим значением перезагружает модель.
+    """
+    merged = {"num_ctx": context_size(model)}
+    if options:
+        merged.update(options)
+    return merged
+
+
+async def load_model(model: str) -> bool:
+    """
+    Загружает модель в память Ollama без генерации (POST /api/generate без prompt).
+    Возвращает True, если хотя бы один узел подтвердил загрузку.
+    """
+    payload = {
+        "model": model,
+        "keep_alive": keep_alive_for(model),
+        "stream": False,
+        "options": model_options(model),
+    }
+    for node in pool.candidates(model):
+        try:
+            async with client.session.post(
+                f"{node.url}/api/generate", json=payload, timeout=LOAD_TIMEOUT
+            ) as resp:
                 if resp.status != 200:
-                    return []
-                print(f"                                 -----------DATA-----------")
-                data = await resp.json()
-                print(data)
-                # Поддерживаем несколько возможных структур ответа
-                models = []
-                # Ollama может вернуть {"models": [{"name": "..."} , ...]} или похожую структуру
-                if isinstance(data, dict):
-                    print(f"Data is dict...")
-                    for k in ("models", "tags", "data"):
-                        print("for key in keys...")
-                        items = data.get(k)
-                        print(f"                         -----------ITEMS BY KEY----------------")
-                        print(items)
-                        if items and isinstance(items, list):
-                            print(f"items exists and items is list")
-                            for it in items:
-                                print("for item in items list")
-                                # если элемент — словарь с ключом "name"
-                                if isinstance(it, dict):
-                                    print(f"item is dict")
-                                    name = it.get("name") or it.get("model") or it.get("id")
-                                    print(f"name: {name}")
-                                    if name:
-                                        print(f"appending to models: {name}")
-                                        models.append(str(name))
-                                # если элемент уже строка
-                                elif isinstance(it, str):
-                                    print(f"item - str, not dict, appending")
-                                    models.append(it)
-                            if models:
-                                print(f"models is list")
-                                return models
-                # если ничего не подошло — пробуем обработать как список строк
-                if isinstance(data, list):
-                    for it in data:
-                        if isinstance(it, str):
-                            models.append(it)
-                        elif isinstance(it, dict):
-                            nm = it.get("name") or it.get("model") or it.get("id")
-                            if nm:
-                                models.append(str(nm))
-                return models
+                    logger.warning("Ollama %s не загрузила %s: HTTP %s", node.url, model, resp.status)
+                    continue
+                await resp.read()
+        except asyncio.CancelledError:
+            raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if _is_connect_error(e):
+                pool.mark_failed(node)
+                continue
+            # Узел жив, но грузит слишком долго — вторую загрузку на другом не начинаем
+            logger.warning("Ollama %s не успела загрузить %s за %s с", node.url, model, OLLAMA_LOAD_TIMEOUT)
+            return False
+        node.loaded.add(model)
+        return True
+    return False
+
+
+async def _fetch_models(node: OllamaNode) -> Optional[List[str]]:
+    try:
+        async with client.session.get(f"{node.url}/api/tags") as resp:
+            # Если сервис вернул не 200 — считаем, что список недоступен
+            if resp.status != 200:
+                logger.warning("Ollama %s /api/tags вернула HTTP %s", node.url, resp.status)
+                return None
+            data = await resp.json()
     except asyncio.TimeoutError:
-        return []
+        logger.warning("Таймаут при запросе списка моделей у %s", node.url)
+        return None
     except Exception:
-        return []
+        logger.warning("Не удалось получить список моделей у %s", node.url, exc_info=True)
+        return None
+    models = _parse_models(data)
+    node.models = set(models)
+    return models
+
+
+async def get_models() -> List[str]:
+    """
+    Возвращает объединённый список имён моделей со всех живых узлов Ollama.
+    В случае ошибки возвращает пустой список (без выбрасывания исключения).
+    """
+    nodes = pool.healthy_nodes() or pool.nodes
+    results = await asyncio.gather(*(_fetch_models(n) for n in nodes))
+    models = []
+    seen = set()
+    for node_models in results:
+        for name in node_models or ():
+            if name not in seen:
+                seen.add(name)
+                models.append(name)
+    logger.debug("Модели Ollama: %s", models)
+    return models
+
+
+class _NotStarted(Exception):
+    """Узел недоступен, стрим не начался — можно повторить на другом узле."""
 
 
 async def generate_stream(
@@ -78,8 +384,9 @@ async def generate_stream(
     system_prompt: str,
     history: list,
     user_prompt: str,
-    on_chunk: Callable[[str], Awaitable[None]]
-):
+    on_chunk: Callable[[str], Awaitable[None]],
+    options: Optional[dict] = None,
+) -> Optional[dict]:
     """
     Запускает стрим-чат через Ollama API (POST /api/chat) и вызывает on_chunk(chunk)
     при получении каждой части ответа. В случае ошибки on_chunk вызывается с текстом ошибки.
@@ -89,92 +396,222 @@ async def generate_stream(
     - history: список сообщений [{'role': 'user'|'assistant', 'content': '...'}, ...]
     - user_prompt: текущий запрос пользователя
     - on_chunk: async-функция, которая принимает строку (кусочек) и возвращает awaitable
+    - options: параметры генерации Ollama (num_predict, ...); num_ctx добавляется сам
+    Возвращает статистику из финального события Ollama (eval_count, eval_duration, ...)
+    или None, если стрим не дошёл до конца.
+    Запрос идёт на лучший узел пула; если узел недоступен до первого токена —
+    повторяется на следующем.
     """
-    url = f"{OLLAMA_URL}/api/chat"
-    print("MESSAGE GENERATING...")
-    print("model: {model}\nsystem_prompt: {system_prompt}\nhistory: {history}\nuser prompt: {user_prompt}")
-
     # Формируем messages (system + history + user)
     messages = [{"role": "system", "content": system_prompt}]
     # history ожидается как список словарей с полями role/content
     if history:
         messages.extend(history)
-        print(f"messages: {messages}")
     messages.append({"role": "user", "content": user_prompt})
-    print(f"messages: {messages}")
 
     payload = {
         "model": model,
         "messages": messages,
-        "stream": True
+        "stream": True,
+        "keep_alive": keep_alive_for(model),
+        "options": model_options(model, options),
     }
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Генерация: model=%s, сообщений=%d", model, len(messages))
+
+    last_error = None
+    for node in pool.candidates(model):
+        try:
+            return await _stream_from(node, payload, on_chunk)
+        except _NotStarted as e:
+            last_error = e.__cause__
+            pool.mark_failed(node)
+    if isinstance(last_error, asyncio.TimeoutError):
+        await on_chunk("\n\n[Ошибка: соединение с Ollama превысило таймаут.]")
+    else:
+        await on_chunk(f"\n\n[Внутренняя ошибка при подключении к Ollama: {last_error}]")
+    return None
+
 
+async def _stream_from(node: OllamaNode, payload: dict, on_chunk) -> Optional[dict]:
+    stats = None
+    started = False
+    node.in_flight += 1
     try:
-        async with aiohttp.ClientSession(timeout=HTTP_TIMEOUT) as session:
-            print(f"opened server transportation.")
-            async with session.post(url, json=payload) as resp:
-                print(f"network with ollama is established")
-                # если сервер дал ошибку — попробуем вернуть тело ошибки пользователю
-                if resp.status != 200:
-                    try:
-                        text = await resp.text()
-                    except Exception:
-                        text = f"HTTP {resp.status}"
-                    await on_chunk(f"\n\n[Ошибка Ollama: {text}]")
-                    return
-
-                # Читаем поток байтов; каждый кусок может быть JSON-строкой
-                async for raw in resp.content:
-                    print(f"reading content...\n")
-                    print(f"raw: {raw}\n")
-                    if not raw:
-                        print(f"no content")
-                        continue
-                    try:
-                        decoded = raw.decode(errors="ignore").strip()
-                        if not decoded:
-                            continue
-                        print(f"decoded message is {type(decoded)}: {decoded}\n")
-                        # Попытка распарсить JSON в ожидаемом формате
-                        data = json.loads(decoded)
-                        print(f"data is: {type(data)}: {data}\n")
-                        # Ожидаем структуру {"message": {"content": "..."}} или похожую
-                        if isinstance(data, dict):
-                            # случай, когда сервер шлёт событие с полем "message"
-                            if "message" in data and isinstance(data["message"], dict):
-                                print(f"data have 'message', data['message'] content, data is dict")
-                                content = data["message"].get("content")
-                                print(f"\nSCREENED CONTENT: {content}\n")
-                                if content:
-                                    await on_chunk(str(content))
-                            # либо сервер может отправлять { "content": "..." }
-                            elif "content" in data:
-                                await on_chunk(str(data["content"]))
-                            else:
-                                # если структура другая — отправим repr
-                                await on_chunk(str(data))
-                        else:
-                            # если это не dict — отправим как текст
-                            await on_chunk(str(data))
-                    except json.JSONDecodeError:
-                        # Если не JSON — пробуем отправить сырый текст
-                        try:
-                            txt = raw.decode(errors="ignore")
-                            await on_chunk(txt)
-                        except Exception:
-                            # молча пропускаем кусочек, который нельзя обработать
-                            pass
-                    except asyncio.CancelledError:
-                        # прерывание — пробрасываем дальше
-                        raise
-                    except Exception as e:
-                        # любая другая единичная ошибка — информируем частичным сообщением
-                        try:
-                            await on_chunk(f"\n\n[Ошибка при обработке стрима: {e}]")
-                        except Exception:
-                            pass
+        try:
+            # Соединение из пула (или новое) и ожидание заголовков ответа
+            with tracing.span("ollama.request", node=node.url):
+                resp = await client.session.post(
+                    f"{node.url}/api/chat",
+                    json=payload,
+                    timeout=_timeout_for(node, payload["model"]),
+                )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if _is_connect_error(e):
+                raise _NotStarted() from e
+            raise
+        async with resp:
+            # если сервер дал ошибку — попробуем вернуть тело ошибки пользователю
+            if resp.status != 200:
+                try:
+                    text = await resp.text()
+                except Exception:
+                    text = f"HTTP {resp.status}"
+                await on_chunk(f"\n\n[Ошибка Ollama: {text}]")
+                return None
+
+            # Читаем поток байтов кусками любой длины; строки собирает декодер
+            decoder = NDJSONDecoder()
+            try:
+                with tracing.span("ollama.stream") as span:
+                    if tracing.active():
+                        stats = await _read_traced(resp, decoder, on_chunk, span)
+                    else:
+                        async for data in resp.content.iter_any():
+                            for event in decoder.feed(data):
+                                started = True
+                                stats = await _dispatch(event, on_chunk) or stats
+                        for event in decoder.close():
+                            stats = await _dispatch(event, on_chunk) or stats
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if not started and _is_connect_error(e):
+                    raise _NotStarted() from e
+                raise
+            except asyncio.CancelledError:
+                # Генерацию остановили: рвём соединение, чтобы Ollama перестала
+                # генерировать, а не дочитываем ответ ради возврата в пул
+                resp.close()
+                raise
+        # Модель на этом узле теперь точно в памяти
+        node.loaded.add(payload["model"])
+    except asyncio.CancelledError:
+        # прерывание — пробрасываем дальше
+        raise
+    except _NotStarted:
+        raise
     except asyncio.TimeoutError:
         await on_chunk("\n\n[Ошибка: соединение с Ollama превысило таймаут.]")
     except Exception as e:
         await on_chunk(f"\n\n[Внутренняя ошибка при подключении к Ollama: {e}]")
+    finally:
+        node.in_flight -= 1
+    return stats
+
+
+async def _read_traced(resp, decoder: NDJSONDecoder, on_chunk, span) -> Optional[dict]:
+    """
+    То же чтение стрима, но с замерами для трассы: сколько времени ушло
+    на разбор NDJSON и сколько — на обработку кусков (правки сообщения и т.п.).
+    Отдельная функция, чтобы в обычном пути не было лишних вызовов perf_counter.
+    """
+    stats = None
+    decode = handle = 0.0
+    chunks = events = 0
+    try:
+        async for data in resp.content.iter_any():
+            chunks += 1
+            t0 = time.perf_counter()
+            batch = decoder.feed(data)
+            t1 = time.perf_counter()
+            for event in batch:
+                events += 1
+                stats = await _dispatch(event, on_chunk) or stats
+            decode += t1 - t0
+            handle += time.perf_counter() - t1
+        for event in decoder.close():
+            stats = await _dispatch(event, on_chunk) or stats
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        if not events and _is_connect_error(e):
+            raise _NotStarted() from e
+        raise
+    finally:
+        span.set(
+            chunks=chunks,
+            events=events,
+            decode_ms=round(decode * 1000, 3),
+            on_chunk_ms=round(handle * 1000, 3),
+        )
+    return stats
+
+
+async def _dispatch(event, on_chunk) -> Optional[dict]:
+    """Передаёт событие стрима обработчику; для Done возвращает статистику."""
+    if isinstance(event, ContentDelta):
+        await on_chunk(event.text)
+    elif isinstance(event, Done):
+        return event.stats
+    elif isinstance(event, StreamError):
+        await on_chunk(f"\n\n[Ошибка Ollama: {event.message}]")
+    return None
+
+
+async def generate_once(model: str, messages: list) -> Optional[str]:
+    """
+    Обычный (не потоковый) чат-запрос: возвращает текст ответа целиком
+    или None при любой ошибке. Используется для служебных задач вроде сжатия истории.
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "stream": False,
+        "keep_alive": keep_alive_for(model),
+        "options": model_options(model),
+    }
+    for node in pool.candidates(model):
+        node.in_flight += 1
+        try:
+            async with client.session.post(
+                f"{node.url}/api/chat", json=payload, timeout=_timeout_for(node, model)
+            ) as resp:
+                if resp.status != 200:
+                    return None
+                data = await resp.json()
+        except asyncio.CancelledError:
+            raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if not _is_connect_error(e):
+                return None
+            pool.mark_failed(node)
+            continue
+        except Exception:
+            return None
+        finally:
+            node.in_flight -= 1
+        if isinstance(data, dict) and isinstance(data.get("message"), dict):
+            content = data["message"].get("content")
+            return str(content) if content else None
+        return None
+    return None
+
 
+async def embed(model: str, texts: List[str]) -> Optional[List[List[float]]]:
+    """
+    Эмбеддинги для пачки текстов одним запросом (/api/embed).
+    Возвращает по вектору на текст или None при любой ошибке.
+    """
+    payload = {"model": model, "input": texts, "keep_alive": keep_alive_for(model)}
+    for node in pool.candidates(model):
+        node.in_flight += 1
+        try:
+            async with client.session.post(
+                f"{node.url}/api/embed", json=payload, timeout=_timeout_for(node, model)
+            ) as resp:
+                if resp.status != 200:
+                    return None
+                data = await resp.json()
+        except asyncio.CancelledError:
+            raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if not _is_connect_error(e):
+                return None
+            pool.mark_failed(node)
+            continue
+        except Exception:
+            return None
+        finally:
+            node.in_flight -= 1
+        vectors = data.get("embeddings") if isinstance(data, dict) else None
+        if not isinstance(vectors, list) or len(vectors) != len(texts):
+            return None
+        return vectors
+    return None
@@ -0,0 +1,93 @@
+# services/profiler.py
+# Профилирование по запросу под реальной нагрузкой: cProfile включается
+# на N секунд в потоке event loop (там выполняются все обработчики и корутины),
+# затем результаты сохраняются в PROFILE_DIR — .pstats для snakeviz/pstats
+# и текстовая сводка с самыми дорогими функциями и состоянием задач asyncio.
+
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+from collections import Counter
+
+from config import PROFILE_DIR, PROFILE_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusy(Exception):
+    """Профилирование уже идёт."""
+
+
+class Profiler:
+    def __init__(self, directory: str, max_seconds: float):
+        self.directory = directory
+        self.max_seconds = max_seconds
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    async def run(self, seconds: float, top: int = 30) -> str:
+        """
+        Профилирует event loop seconds секунд и возвращает путь к текстовой сводке.
+        Бросает ProfilerBusy, если профилирование уже идёт.
+        """
+        if self._running:
+            raise ProfilerBusy()
+        seconds = max(1.0, min(float(seconds), self.max_seconds))
+        self._running = True
+        profile = cProfile.Profile()
+        logger.info("Профилирование запущено на %.0f с", seconds)
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            tasks = _task_summary()
+        finally:
+            self._running = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        # Запись на диск и форматирование — не в event loop
+        return await asyncio.to_thread(self._dump, profile, base, seconds, top, tasks)
+
+    @staticmethod
+    def _dump(profile: cProfile.Profile, base: str, seconds: float, top: int, tasks: str) -> str:
+        profile.dump_stats(base + ".pstats")
+        out = io.StringIO()
+        out.write(f"Профиль за {seconds:.0f} с\n\n{tasks}\n\n")
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+        path = base + ".txt"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        logger.info("Профиль сохранён: %s(.pstats)", path)
+        return path
+
+
+def _task_summary() -> str:
+    """Сколько задач asyncio сейчас живо и на каких корутинах они стоят."""
+    counts = Counter()
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        counts[getattr(coro, "__qualname__", repr(coro))] += 1
+    lines = [f"Задач asyncio: {sum(counts.values())}"]
+    lines.extend(f"  {n:5d}  {name}" for name, n in counts.most_common(20))
+    return "\n".join(lines)
+
+
+def summary_head(path: str, limit: int = 3500) -> str:
+    """Начало текстовой сводки — чтобы отправить его в чат."""
+    with open(path, encoding="utf-8") as f:
+        return f.read(limit)
+
+
+profiler = Profiler(PROFILE_DIR, PROFILE_MAX_SECONDS)
@@ -0,0 +1,73 @@
+# services/residency.py
+# Управление тем, какие модели загружены в память Ollama.
+# - модель прогревается в фоне сразу, как только пользователь её выбрал;
+# - закреплённые модели (OLLAMA_PINNED_MODELS) держатся в памяти постоянно;
+# - что реально загружено, узнаём из /api/ps (его опрашивает пул узлов).
+
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from config import OLLAMA_PINNED_MODELS, RESIDENCY_CHECK_INTERVAL_SECONDS
+from services.ollama_client import load_model, pool
+
+logger = logging.getLogger(__name__)
+
+
+class ModelResidency:
+    def __init__(self, pinned, interval: float):
+        self.pinned = list(pinned)
+        self.interval = interval
+        # model -> идущая загрузка (не больше одной на модель)
+        self._warming: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def is_resident(self, model: str) -> bool:
+        return pool.is_loaded(model)
+
+    def warm(self, model: str) -> Optional[asyncio.Task]:
+        """Запускает фоновую загрузку модели, если она ещё не в памяти."""
+        if self.is_resident(model):
+            return None
+        task = self._warming.get(model)
+        if task is not None and not task.done():
+            return task
+        task = asyncio.create_task(self._warm(model))
+        self._warming[model] = task
+        task.add_done_callback(lambda _: self._warming.pop(model, None))
+        return task
+
+    async def _warm(self, model: str):
+        logger.info("Прогреваем модель %s", model)
+        if await load_model(model):
+            logger.info("Модель %s загружена", model)
+        else:
+            logger.warning("Не удалось прогреть модель %s", model)
+
+    async def start(self):
+        for model in self.pinned:
+            self.warm(model)
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._warming.values()):
+            task.cancel()
+
+    async def _loop(self):
+        # Закреплённые модели могли выгрузить (перезапуск Ollama, нехватка памяти) —
+        # периодически возвращаем их обратно
+        while True:
+            await asyncio.sleep(self.interval)
+            for model in self.pinned:
+                self.warm(model)
+
+
+residency = ModelResidency(OLLAMA_PINNED_MODELS, RESIDENCY_CHECK_INTERVAL_SECONDS)
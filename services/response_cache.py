@@ -0,0 +1,219 @@
+# services/response_cache.py
+# Кэш ответов и объединение одинаковых одновременных запросов.
+# Ключ — (модель, system prompt, нормализованная история, нормализованный запрос).
+# - готовый ответ проигрывается через тот же on_chunk, что и живая генерация;
+# - если такой же запрос уже генерируется — новый запрос подписывается на него
+#   и получает те же куски, вместо второго похода в Ollama.
+# Включается флагом RESPONSE_CACHE_ENABLED.
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import (
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_TTL_SECONDS,
+    RESPONSE_CACHE_REPLAY_CHUNK,
+)
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+OnChunk = Callable[[str], Awaitable[None]]
+# Запускает настоящую генерацию: принимает on_chunk, возвращает статистику Ollama
+# (None — генерация не завершилась успешно; {"truncated": True, ...} — ответ обрезан.
+# Такие ответы не кэшируются, но подписчики получают ту же статистику)
+Runner = Callable[[OnChunk], Awaitable[Optional[dict]]]
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+def make_key(model: str, system_prompt: str, history: List[dict], prompt: str) -> str:
+    parts = [
+        model,
+        system_prompt.strip(),
+        [(m["role"], _normalize(m["content"])) for m in history],
+        _normalize(prompt),
+    ]
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("text", "stats", "expires", "size")
+
+    def __init__(self, text: str, stats: dict, expires: float):
+        self.text = text
+        self.stats = stats
+        self.expires = expires
+        self.size = len(text.encode("utf-8"))
+
+
+class _Flight:
+    """Генерация, на которую могут подписаться одинаковые запросы."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.subscribers: List[OnChunk] = []
+        self.done = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+
+    async def fanout(self, chunk: str):
+        self.chunks.append(chunk)
+        for on_chunk in list(self.subscribers):
+            try:
+                await on_chunk(chunk)
+            except Exception:
+                logger.exception("Подписчик общей генерации упал")
+
+
+class ResponseCache:
+    def __init__(self, enabled: bool, max_entries: int, max_bytes: int, ttl: float):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._flights: Dict[str, _Flight] = {}
+        self._tasks = set()
+
+    def _get(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    def _put(self, key: str, text: str, stats: dict):
+        entry = _Entry(text, stats, time.monotonic() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+        # Вытесняем самые давно использованные записи
+        while self._entries and (
+            len(self._entries) > self.max_entries or self.bytes > self.max_bytes
+        ):
+            self._drop(next(iter(self._entries)))
+
+    async def generate(
+        self,
+        model: str,
+        system_prompt: str,
+        history: List[dict],
+        prompt: str,
+        on_chunk: OnChunk,
+        run: Runner,
+    ) -> Optional[dict]:
+        """
+        Отдаёт ответ из кэша, подписывается на такую же идущую генерацию
+        или запускает новую через run(on_chunk). Возвращает статистику Ollama.
+        """
+        if not self.enabled:
+            return await run(on_chunk)
+
+        key = make_key(model, system_prompt, history, prompt)
+        entry = self._get(key)
+        if entry is not None:
+            self.hits += 1
+            metrics.response_cache_requests.inc(result="hit")
+            step = RESPONSE_CACHE_REPLAY_CHUNK
+            for i in range(0, len(entry.text), step):
+                await on_chunk(entry.text[i:i + step])
+            return dict(entry.stats, cached=True)
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.joins += 1
+            metrics.response_cache_requests.inc(result="join")
+            # Догоняем уже сгенерированное и подписываемся на остальное.
+            # Между последней проверкой длины и подпиской нет await — куски не теряются
+            i = 0
+            while i < len(flight.chunks):
+                await on_chunk(flight.chunks[i])
+                i += 1
+            flight.subscribers.append(on_chunk)
+            return await self._wait(flight, on_chunk)
+
+        self.misses += 1
+        metrics.response_cache_requests.inc(result="miss")
+        flight = _Flight()
+        flight.subscribers.append(on_chunk)
+        self._flights[key] = flight
+        # Генерация идёт в отдельной задаче: отмена одного из ожидающих
+        # не должна обрывать ответ для остальных
+        task = asyncio.create_task(self._lead(key, flight, run))
+        flight.task = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return await self._wait(flight, on_chunk)
+
+    async def _wait(self, flight: _Flight, on_chunk: OnChunk) -> Optional[dict]:
+        try:
+            return await asyncio.shield(flight.done)
+        except asyncio.CancelledError:
+            # Ожидающий ушёл (например, генерацию остановили) — отписываем его,
+            # а если слушать больше некому, останавливаем и саму генерацию
+            if on_chunk in flight.subscribers:
+                flight.subscribers.remove(on_chunk)
+            if not flight.subscribers and flight.task is not None:
+                flight.task.cancel()
+            raise
+
+    async def _lead(self, key: str, flight: _Flight, run: Runner):
+        try:
+            stats = await run(flight.fanout)
+        except asyncio.CancelledError:
+            self._flights.pop(key, None)
+            flight.done.cancel()
+            raise
+        except Exception as e:
+            self._flights.pop(key, None)
+            flight.done.set_exception(e)
+            # Исключение получат ожидающие; помечаем его как полученное,
+            # чтобы asyncio не ругался, если ожидающих уже нет
+            flight.done.exception()
+            return
+        self._flights.pop(key, None)
+        if stats is not None and not stats.get("truncated"):
+            self._put(key, "".join(flight.chunks), stats)
+        flight.done.set_result(stats)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "joins": self.joins,
+            "misses": self.misses,
+            "in_flight": len(self._flights),
+        }
+
+
+response_cache = ResponseCache(
+    enabled=RESPONSE_CACHE_ENABLED,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,216 @@
+# services/scheduler.py
+# Планировщик генераций: ограничивает число одновременных запросов к Ollama
+# (всего и на модель) и справедливо раздаёт слоты между пользователями.
+# - у каждого пользователя не больше одной генерации одновременно;
+# - очереди пользователей обслуживаются по кругу (round-robin);
+# - общая очередь ограничена, слишком долгое ожидание прерывается.
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from config import (
+    GEN_MAX_CONCURRENT,
+    GEN_MAX_PER_MODEL,
+    GEN_QUEUE_SIZE,
+    GEN_QUEUE_TIMEOUT_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Колбэк, которому сообщают позицию в очереди (1 — следующий)
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class QueueFull(Exception):
+    """Очередь генераций заполнена."""
+
+
+class QueueTimeout(Exception):
+    """Запрос слишком долго ждал своей очереди."""
+
+
+class _Waiter:
+    __slots__ = ("user_id", "model", "future", "on_position", "position", "enqueued_at")
+
+    def __init__(self, user_id: int, model: str, on_position: Optional[PositionCallback]):
+        self.user_id = user_id
+        self.model = model
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = 0
+        self.enqueued_at = time.monotonic()
+
+
+class GenerationScheduler:
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_per_model: Dict[str, int],
+        queue_size: int,
+        queue_timeout: float,
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        # "*" — лимит по умолчанию для моделей, не перечисленных явно
+        self.max_per_model = max_per_model
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._per_model: Dict[str, int] = {}
+        self._active_users = set()
+        # user_id -> очередь его запросов; порядок ключей — порядок обхода по кругу
+        self._queues: "OrderedDict[int, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+        self._notify_tasks = set()
+
+    def share(self, parts: int):
+        """
+        Делит лимиты между parts процессами-воркерами (режим webhook): Ollama у них
+        общая, и без этого она получила бы в parts раз больше одновременных запросов.
+        Меньше одного слота на воркер не бывает.
+        """
+        if parts <= 1:
+            return
+        self.max_concurrent = max(1, self.max_concurrent // parts)
+        self.max_per_model = {m: max(1, n // parts) for m, n in self.max_per_model.items()}
+        self.queue_size = max(1, self.queue_size // parts)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _model_limit(self, model: str) -> int:
+        return self.max_per_model.get(model, self.max_per_model.get("*", self.max_concurrent))
+
+    def _can_run(self, w: _Waiter) -> bool:
+        return (
+            self.in_flight < self.max_concurrent
+            and w.user_id not in self._active_users
+            and self._per_model.get(w.model, 0) < self._model_limit(w.model)
+        )
+
+    def _acquire(self, user_id: int, model: str):
+        self.in_flight += 1
+        self._per_model[model] = self._per_model.get(model, 0) + 1
+        self._active_users.add(user_id)
+
+    def _release(self, user_id: int, model: str):
+        self.in_flight -= 1
+        self._per_model[model] -= 1
+        if not self._per_model[model]:
+            del self._per_model[model]
+        self._active_users.discard(user_id)
+        self._pump()
+
+    def _remove(self, w: _Waiter):
+        q = self._queues.get(w.user_id)
+        if q is None or w not in q:
+            return
+        q.remove(w)
+        self._queued -= 1
+        if not q:
+            del self._queues[w.user_id]
+
+    def _pump(self):
+        """Раздаёт освободившиеся слоты по кругу между пользователями."""
+        progressed = True
+        while progressed and self._queues and self.in_flight < self.max_concurrent:
+            progressed = False
+            for user_id in list(self._queues):
+                q = self._queues[user_id]
+                w = q[0]
+                if not self._can_run(w):
+                    continue
+                q.popleft()
+                self._queued -= 1
+                del self._queues[user_id]
+                if q:
+                    # Остальные запросы пользователя — в конец круга
+                    self._queues[user_id] = q
+                self._acquire(w.user_id, w.model)
+                w.future.set_result(None)
+                progressed = True
+                break
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Сообщает ожидающим их новую позицию (только если она изменилась)."""
+        # Позиция — порядок, в котором запросы будут выбраны при обходе по кругу
+        rounds = [list(q) for q in self._queues.values()]
+        pos = 0
+        depth = 0
+        while True:
+            layer = [q[depth] for q in rounds if depth < len(q)]
+            if not layer:
+                break
+            for w in layer:
+                pos += 1
+                if w.position != pos and w.on_position is not None:
+                    w.position = pos
+                    task = asyncio.create_task(self._safe_notify(w, pos))
+                    self._notify_tasks.add(task)
+                    task.add_done_callback(self._notify_tasks.discard)
+            depth += 1
+
+    @staticmethod
+    async def _safe_notify(w: _Waiter, pos: int):
+        try:
+            await w.on_position(pos)
+        except Exception:
+            logger.debug("Не удалось сообщить позицию в очереди", exc_info=True)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        model: str,
+        on_position: Optional[PositionCallback] = None,
+    ):
+        """
+        Ждёт свободный слот для генерации и держит его внутри блока async with.
+        Бросает QueueFull, если очередь заполнена, и QueueTimeout,
+        если слот не освободился за queue_timeout секунд.
+        Внутри блока доступно время ожидания: `async with ... as waited`.
+        """
+        w = _Waiter(user_id, model, on_position)
+        # Все, кто ждёт в очереди, упёрлись в свой лимит (иначе _pump их бы уже
+        # запустил), поэтому запрос, который может идти сейчас, никого не обгоняет.
+        # Исключение — свои же запросы пользователя: они идут по порядку
+        if w.user_id not in self._queues and self._can_run(w):
+            self._acquire(user_id, model)
+        else:
+            if self._queued >= self.queue_size:
+                raise QueueFull()
+            self._queues.setdefault(user_id, deque()).append(w)
+            self._queued += 1
+            self._notify_positions()
+            try:
+                await asyncio.wait_for(asyncio.shield(w.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not w.future.done():
+                    self._remove(w)
+                    self._notify_positions()
+                    raise QueueTimeout()
+            except BaseException:
+                if w.future.done():
+                    # Слот успели выдать — возвращаем его
+                    self._release(user_id, model)
+                else:
+                    self._remove(w)
+                    self._notify_positions()
+                raise
+        try:
+            yield time.monotonic() - w.enqueued_at
+        finally:
+            self._release(user_id, model)
+
+
+scheduler = GenerationScheduler(
+    max_concurrent=GEN_MAX_CONCURRENT,
+    max_per_model=GEN_MAX_PER_MODEL,
+    queue_size=GEN_QUEUE_SIZE,
+    queue_timeout=GEN_QUEUE_TIMEOUT_SECONDS,
+)
@@ -0,0 +1,189 @@
+# services/tracing.py
+# Лёгкая трассировка обработки сообщения: корневая трасса на сообщение
+# и вложенные спаны (очередь, соединение с Ollama, стрим, правки в Telegram...).
+# Трассируется доля TRACE_SAMPLE_RATE сообщений; вне трассы span() возвращает
+# общий пустой объект, поэтому выключенная трассировка почти ничего не стоит.
+# Текущая трасса живёт в contextvar и сама переходит в задачи, созданные внутри неё.
+# Готовая трасса пишется одной JSON-строкой в TRACE_FILE (с ротацией).
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import random
+import time
+import uuid
+from typing import Optional, Tuple
+
+from config import TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUPS
+
+logger = logging.getLogger(__name__)
+
+# (трасса, индекс текущего спана или -1 для корня)
+_current: contextvars.ContextVar[Optional[Tuple["_Trace", int]]] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+_writer: Optional[logging.Logger] = None
+
+
+def _get_writer() -> logging.Logger:
+    global _writer
+    if _writer is None:
+        writer = logging.getLogger("hubert.traces")
+        writer.propagate = False
+        writer.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(
+            TRACE_FILE,
+            maxBytes=TRACE_FILE_MAX_BYTES,
+            backupCount=TRACE_FILE_BACKUPS,
+            encoding="utf-8",
+            delay=True,
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        writer.addHandler(handler)
+        _writer = writer
+    return _writer
+
+
+class _Noop:
+    """Заглушка вместо спана, когда трасса не пишется."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _Noop()
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "index", "parent", "start", "_token")
+
+    def __init__(self, trace: "_Trace", name: str, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        current = _current.get()
+        self.parent = current[1] if current is not None else -1
+        self.start = time.perf_counter()
+        self.index = self.trace.add(self)
+        self._token = _current.set((self.trace, self.index))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.trace.end(self, exc_type)
+        return False
+
+
+class _Trace:
+    __slots__ = ("id", "name", "attrs", "started_at", "start", "spans", "closed", "_token")
+
+    def __init__(self, name: str, attrs: dict):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.closed = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, span: _Span) -> int:
+        record = {
+            "name": span.name,
+            "parent": span.parent,
+            "start_ms": round((span.start - self.start) * 1000, 3),
+            "duration_ms": None,
+        }
+        self.spans.append(record)
+        return len(self.spans) - 1
+
+    def end(self, span: _Span, exc_type):
+        record = self.spans[span.index]
+        record["duration_ms"] = round((time.perf_counter() - span.start) * 1000, 3)
+        if span.attrs:
+            record["attrs"] = span.attrs
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self._token = _current.set((self, -1))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.closed = True
+        data = {
+            "trace": self.id,
+            "name": self.name,
+            "ts": round(self.started_at, 3),
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "attrs": self.attrs,
+            "spans": self.spans,
+        }
+        if exc_type is not None:
+            data["error"] = exc_type.__name__
+        try:
+            _get_writer().info(json.dumps(data, ensure_ascii=False, default=str))
+        except Exception:
+            logger.exception("Не удалось записать трассу")
+        return False
+
+
+def trace(name: str, **attrs):
+    """
+    Корневая трасса обработки сообщения (with trace(...) as t).
+    Пишется только для доли TRACE_SAMPLE_RATE сообщений.
+    """
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return _NOOP
+    return _Trace(name, attrs)
+
+
+def span(name: str, **attrs):
+    """Вложенный спан текущей трассы (with span(...) as s); вне трассы ничего не делает."""
+    current = _current.get()
+    if current is None or current[0].closed:
+        return _NOOP
+    return _Span(current[0], name, attrs)
+
+
+def active() -> bool:
+    """Пишется ли сейчас трасса (чтобы не делать лишних замеров вне неё)."""
+    current = _current.get()
+    return current is not None and not current[0].closed
+
+
+def record(name: str, seconds: float, **attrs):
+    """Добавляет уже закончившийся спан длиной seconds (например, ожидание в очереди)."""
+    current = _current.get()
+    if current is None or current[0].closed:
+        return
+    s = _Span(current[0], name, attrs)
+    s.parent = current[1]
+    s.start = time.perf_counter() - seconds
+    s.index = s.trace.add(s)
+    s.trace.end(s, None)
+
+
+def annotate(**attrs):
+    """Дописывает атрибуты в корень текущей трассы (например, исход генерации)."""
+    current = _current.get()
+    if current is not None and not current[0].closed:
+        current[0].set(**attrs)
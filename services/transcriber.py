@@ -0,0 +1,245 @@
+# services/transcriber.py
+# Сервис распознавания речи: заранее загруженные модели faster-whisper
+# в пуле потоков, ограниченная очередь и прогрев при старте.
+# CTranslate2 отпускает GIL во время вычислений, поэтому потоков достаточно —
+# event loop бота при распознавании не блокируется.
+# Аудио принимается прямо из памяти (file-like объект), сегменты текста отдаются
+# по мере распознавания; длинные записи декодируются и распознаются кусками.
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from config import (
+    WHISPER_MODEL_SIZE,
+    WHISPER_DEVICE,
+    WHISPER_COMPUTE_TYPE,
+    WHISPER_CPU_THREADS,
+    WHISPER_WORKERS,
+    WHISPER_QUEUE_SIZE,
+    WHISPER_LANGUAGE,
+    WHISPER_LONG_AUDIO_SECONDS,
+    WHISPER_CHUNK_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Частота дискретизации, с которой работает Whisper
+SAMPLE_RATE = 16000
+
+# Признак конца распознавания в очереди сегментов
+_DONE = object()
+
+
+def iter_audio_chunks(audio, seconds: float) -> Iterator:
+    """
+    Декодирует аудио (путь или file-like объект) потоково через PyAV и отдаёт
+    куски по seconds секунд: float32, моно, 16 кГц. Целиком волна в памяти
+    не собирается.
+    """
+    import av
+    import numpy as np
+
+    size = int(seconds * SAMPLE_RATE)
+    buffered = []
+    count = 0
+
+    def take(arrays, n):
+        data = np.concatenate(arrays)
+        return data[:n].astype(np.float32) / 32768.0, data[n:]
+
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+    with av.open(audio, mode="r", metadata_errors="ignore") as container:
+        frames = container.decode(audio=0)
+        for frame in _with_flush(frames):
+            for out in resampler.resample(frame):
+                samples = out.to_ndarray().reshape(-1)
+                buffered.append(samples)
+                count += len(samples)
+                while count >= size:
+                    chunk, rest = take(buffered, size)
+                    buffered, count = [rest], len(rest)
+                    yield chunk
+    if count:
+        chunk, _ = take(buffered, count)
+        yield chunk
+
+
+def _with_flush(frames):
+    # None в конце заставляет ресемплер отдать остаток
+    yield from frames
+    yield None
+
+
+class TranscriberBusy(Exception):
+    """Очередь на распознавание переполнена — запрос нужно отклонить."""
+
+
+class TranscriberUnavailable(Exception):
+    """Модели распознавания не загружены (нет faster-whisper или ошибка загрузки)."""
+
+
+class TranscriptionService:
+    """
+    Пул из workers моделей WhisperModel. Каждый запрос берёт свободную модель,
+    выполняет transcribe в отдельном потоке и возвращает модель в пул.
+    Одновременно принимается не больше workers + queue_size запросов.
+    """
+
+    def __init__(
+        self,
+        model_size: str,
+        device: str,
+        compute_type: str,
+        cpu_threads: int,
+        workers: int,
+        queue_size: int,
+        language: str,
+    ):
+        self.model_size = model_size
+        self.device = device
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.language = language
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._models: Optional[asyncio.Queue] = None
+        self._start_lock = asyncio.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Сколько запросов сейчас распознаётся или ждёт свободную модель."""
+        return self._pending
+
+    async def start(self):
+        """Загружает модели и прогревает их. Повторный вызов ничего не делает."""
+        async with self._start_lock:
+            if self._models is not None:
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="whisper"
+            )
+            loop = asyncio.get_running_loop()
+            try:
+                models = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(self._executor, self._load)
+                        for _ in range(self.workers)
+                    )
+                )
+            except Exception:
+                logger.exception("Не удалось загрузить модели распознавания речи")
+                self._executor.shutdown(wait=False)
+                self._executor = None
+                return
+            queue = asyncio.Queue()
+            for m in models:
+                queue.put_nowait(m)
+            self._models = queue
+            logger.info(
+                "Распознавание речи готово: %d x whisper-%s (%s, %s)",
+                self.workers, self.model_size, self.device, self.compute_type,
+            )
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._models = None
+
+    def _load(self):
+        from faster_whisper import WhisperModel
+        import numpy as np
+
+        model = WhisperModel(
+            self.model_size,
+            device=self.device,
+            compute_type=self.compute_type,
+            cpu_threads=self.cpu_threads,
+        )
+        # Прогрев: одна секунда тишины, чтобы первый реальный запрос не платил
+        # за инициализацию
+        segments, _ = model.transcribe(
+            np.zeros(16000, dtype=np.float32), language=self.language
+        )
+        for _ in segments:
+            pass
+        return model
+
+    def _run(
+        self, model, audio, duration: float, emit: Callable[[str], None], stop: threading.Event
+    ):
+        if duration > WHISPER_LONG_AUDIO_SECONDS:
+            chunks = iter_audio_chunks(audio, WHISPER_CHUNK_SECONDS)
+        else:
+            chunks = (audio,)
+        prompt = None
+        for chunk in chunks:
+            # Хвост предыдущего куска — подсказка, чтобы не терять контекст на стыке
+            segments, _ = model.transcribe(chunk, language=self.language, initial_prompt=prompt)
+            # segments — ленивый генератор, распознавание идёт при итерации
+            for seg in segments:
+                if stop.is_set():
+                    return
+                text = seg.text.strip()
+                if text:
+                    emit(text)
+                    prompt = text
+
+    async def stream(self, audio, duration: float = 0) -> AsyncIterator[str]:
+        """
+        Распознаёт аудио (путь к файлу, file-like объект или массив сэмплов)
+        и отдаёт текст сегментов по мере готовности. duration — длина записи
+        в секундах: длинные записи распознаются кусками.
+        Бросает TranscriberBusy, если очередь заполнена,
+        и TranscriberUnavailable, если модели не загружены.
+        """
+        if self._models is None:
+            await self.start()
+        if self._models is None:
+            raise TranscriberUnavailable()
+        if self._pending >= self.workers + self.queue_size:
+            raise TranscriberBusy()
+
+        self._pending += 1
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def emit(text: str):
+            loop.call_soon_threadsafe(queue.put_nowait, text)
+
+        try:
+            models = self._models
+            model = await models.get()
+            fut = loop.run_in_executor(self._executor, self._run, model, audio, duration, emit, stop)
+            # Модель возвращается в пул только когда поток действительно закончил,
+            # даже если ожидающий обработчик был отменён
+            fut.add_done_callback(lambda _: models.put_nowait(model))
+            fut.add_done_callback(lambda _: queue.put_nowait(_DONE))
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    break
+                yield item
+            # Пробрасываем ошибку распознавания, если она была
+            await fut
+        finally:
+            # Если обработчик ушёл раньше — поток бросит распознавание на ближайшем сегменте
+            stop.set()
+            self._pending -= 1
+
+
+transcriber = TranscriptionService(
+    model_size=WHISPER_MODEL_SIZE,
+    device=WHISPER_DEVICE,
+    compute_type=WHISPER_COMPUTE_TYPE,
+    cpu_threads=WHISPER_CPU_THREADS,
+    workers=WHISPER_WORKERS,
+    queue_size=WHISPER_QUEUE_SIZE,
+    language=WHISPER_LANGUAGE,
+)
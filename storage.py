@@ -1,31 +1,383 @@
 # storage.py
-# Простейшее in-memory хранилище для настроек каждого пользователя.
-# Позже можно заменить на базу данных (SQLite/Redis/etc).
+# Хранилище настроек каждого пользователя.
+# Активные пользователи держатся в памяти (LRU), а изменения пишутся в бэкенд
+# (SQLite) пачками в фоне — одна транзакция на все накопившиеся изменения.
+# Сессия пользователя — компактный объект со __slots__; общий system prompt
+# и имена моделей не копируются на каждого пользователя. Сессии в памяти
+# ограничены бюджетом STORAGE_MEMORY_BUDGET_MB: сверх него давно неактивные
+# и уже сохранённые сессии выгружаются.
 
-from config import DEFAULT_MODEL, DEFAULT_SYSTEM_PROMPT
+import asyncio
+import json
+import logging
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
 
-# Словарь: user_id -> данные
-# Структура для одного пользователя:
-# {
-#   "model": str,
-#   "system_prompt": str,
-#   "history": list of {"role": "user"/"assistant", "content": "..."},
-#   "waiting_for_prompt": bool
-# }
-user_data = {}
+from config import (
+    DEFAULT_MODEL,
+    DEFAULT_SYSTEM_PROMPT,
+    STORAGE_BACKEND,
+    STORAGE_SQLITE_PATH,
+    STORAGE_HOT_USERS,
+    STORAGE_FLUSH_INTERVAL_SECONDS,
+    STORAGE_MEMORY_BUDGET_MB,
+)
 
+logger = logging.getLogger(__name__)
 
-def get_user(user_id: int):
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+
+# Реплика истории: (роль, текст). Кортеж из двух ссылок в несколько раз меньше
+# словаря, а роль — всегда одна из интернированных строк выше
+Turn = Tuple[str, str]
+
+# Примерный размер объектов, которые не видны через sys.getsizeof строк
+_SESSION_OVERHEAD = sys.getsizeof(object()) + 6 * 8
+_TURN_OVERHEAD = sys.getsizeof(("", "")) + 8  # кортеж + ссылка на него в списке
+
+
+def _shared(value: str, default: str) -> str:
+    # Значение по умолчанию — один объект на весь процесс, а не копия из JSON
+    return default if value == default else value
+
+
+class Session:
     """
-    Возвращает объект настроек пользователя, создаёт по умолчанию при отсутствии.
+    Настройки и история одного пользователя.
+    history — список реплик (роль, текст); в формат Ollama их переводит messages().
     """
-    if user_id not in user_data:
-        # Инициализация значениями по умолчанию
-        user_data[user_id] = {
-            "model": DEFAULT_MODEL,
-            "system_prompt": DEFAULT_SYSTEM_PROMPT,
-            "history": [],
-            "waiting_for_prompt": False
+
+    __slots__ = ("model", "system_prompt", "history", "summary", "waiting_for_prompt", "size")
+
+    def __init__(self):
+        self.model: str = DEFAULT_MODEL
+        self.system_prompt: str = DEFAULT_SYSTEM_PROMPT
+        self.history: List[Turn] = []
+        self.summary: str = ""
+        self.waiting_for_prompt: bool = False
+        # Примерный размер в байтах на момент последнего изменения
+        self.size: int = 0
+
+    def set_model(self, model: str):
+        self.model = sys.intern(model)
+
+    def set_system_prompt(self, prompt: str):
+        self.system_prompt = _shared(prompt, DEFAULT_SYSTEM_PROMPT)
+
+    def add_turn(self, prompt: str, reply: str):
+        """Добавляет в историю вопрос пользователя и ответ модели."""
+        self.history.append((ROLE_USER, prompt))
+        self.history.append((ROLE_ASSISTANT, reply))
+
+    def messages(self, start: int = 0) -> List[dict]:
+        """Реплики истории начиная со start в формате сообщений Ollama."""
+        return [{"role": role, "content": content} for role, content in self.history[start:]]
+
+    def approx_bytes(self) -> int:
+        """Примерный объём памяти сессии без учёта общих (разделяемых) строк."""
+        size = _SESSION_OVERHEAD + sys.getsizeof(self.history)
+        size += sum(_TURN_OVERHEAD + sys.getsizeof(content) for _, content in self.history)
+        if self.system_prompt is not DEFAULT_SYSTEM_PROMPT:
+            size += sys.getsizeof(self.system_prompt)
+        if self.summary:
+            size += sys.getsizeof(self.summary)
+        return size
+
+    def to_dict(self) -> dict:
+        return {
+            "model": self.model,
+            "system_prompt": self.system_prompt,
+            # В базе история хранится в прежнем формате — старые записи читаются как есть
+            "history": self.messages(),
+            "summary": self.summary,
+            "waiting_for_prompt": self.waiting_for_prompt,
         }
-    return user_data[user_id]
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Session":
+        session = cls()
+        session.set_model(data.get("model") or DEFAULT_MODEL)
+        session.set_system_prompt(data.get("system_prompt") or DEFAULT_SYSTEM_PROMPT)
+        session.history = [
+            (ROLE_USER if m.get("role") == ROLE_USER else ROLE_ASSISTANT, m.get("content", ""))
+            for m in data.get("history") or []
+        ]
+        session.summary = data.get("summary") or ""
+        session.waiting_for_prompt = bool(data.get("waiting_for_prompt"))
+        return session
+
+
+class MemoryBackend:
+    """Ничего не сохраняет: данные живут только пока работает процесс."""
+
+    # Выгруженного из памяти пользователя потом не восстановить
+    persistent = False
+
+    def open(self):
+        pass
+
+    def load(self, user_id: int) -> Optional[dict]:
+        return None
+
+    def save_many(self, items: Dict[int, str]):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """
+    SQLite в режиме WAL: чтения не блокируются записью, а пачка изменений
+    пишется одной транзакцией. Данные пользователя хранятся JSON-строкой.
+    База открывается при старте хранилища (или первом обращении), а не при импорте.
+    Соединений два: запись идёт из потока пачками, а чтение — из event loop
+    через своё соединение и не ждёт, пока допишется пачка.
+    """
+
+    persistent = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._read_conn: Optional[sqlite3.Connection] = None
+        # Защищает открытие базы и соединение для записи
+        self._lock = threading.Lock()
+
+    def open(self):
+        with self._lock:
+            if self._write_conn is not None:
+                return
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " user_id INTEGER PRIMARY KEY,"
+                " data TEXT NOT NULL)"
+            )
+            reader = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            reader.execute("PRAGMA query_only=ON")
+            self._write_conn, self._read_conn = conn, reader
+
+    def load(self, user_id: int) -> Optional[dict]:
+        if self._read_conn is None:
+            self.open()
+        row = self._read_conn.execute(
+            "SELECT data FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_many(self, items: Dict[int, str]):
+        if self._write_conn is None:
+            self.open()
+        with self._lock:
+            conn = self._write_conn
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                    items.items(),
+                )
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            for conn in (self._read_conn, self._write_conn):
+                if conn is not None:
+                    conn.close()
+            self._write_conn = self._read_conn = None
+
+
+class UserStore:
+    """
+    Кэш активных пользователей поверх бэкенда.
+    - get() загружает пользователя из бэкенда при первом обращении;
+    - mark_dirty() помечает пользователя изменённым, фоновая задача раз в
+      flush_interval секунд сохраняет всех изменённых одной транзакцией;
+    - в памяти держится не больше max_hot пользователей и не больше
+      max_bytes (примерно) — вытесняются давно неактивные и уже сохранённые;
+    - сессию, которую держит обработчик (pin()), не вытесняют: иначе следующее
+      сообщение загрузило бы вторую копию, и один из ходов потерялся бы.
+    """
+
+    def __init__(self, backend, max_hot: int, flush_interval: float, max_bytes: int):
+        self.backend = backend
+        self.max_hot = max_hot
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.hot: "OrderedDict[int, Session]" = OrderedDict()
+        # Сумма Session.size по всем сессиям в hot
+        self.bytes = 0
+        self.evicted = 0
+        self._dirty = set()
+        # user_id -> сколько обработчиков сейчас держат сессию
+        self._pins: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def get(self, user_id: int) -> Session:
+        user = self.hot.get(user_id)
+        if user is not None:
+            self.hot.move_to_end(user_id)
+            return user
+        try:
+            stored = self.backend.load(user_id)
+        except Exception:
+            logger.exception("Не удалось загрузить пользователя %s", user_id)
+            stored = None
+        user = Session.from_dict(stored) if stored else Session()
+        self._put(user_id, user)
+        self._evict()
+        return user
+
+    def _put(self, user_id: int, user: Session):
+        old = self.hot.get(user_id)
+        if old is not None:
+            self.bytes -= old.size
+        user.size = user.approx_bytes()
+        self.bytes += user.size
+        self.hot[user_id] = user
+        self.hot.move_to_end(user_id)
+
+    @contextmanager
+    def pin(self, user_id: int) -> Iterator[Session]:
+        """Держит сессию в памяти до выхода из блока (на время обработки сообщения)."""
+        user = self.get(user_id)
+        self._pins[user_id] = self._pins.get(user_id, 0) + 1
+        try:
+            yield user
+        finally:
+            self._pins[user_id] -= 1
+            if not self._pins[user_id]:
+                del self._pins[user_id]
+
+    def mark_dirty(self, user_id: int, user: Optional[Session] = None):
+        current = self.hot.get(user_id)
+        if user is None:
+            user = current
+        if user is None:
+            return
+        if current is not None and current is not user:
+            # Сессию вытеснили и загрузили заново, пока её держали без pin():
+            # подменять свежую копию устаревшей нельзя
+            logger.error("Изменения устаревшей сессии пользователя %s не сохранены", user_id)
+            return
+        self._put(user_id, user)
+        self._dirty.add(user_id)
+
+    def _evict(self):
+        if not self.backend.persistent:
+            # Без постоянного хранилища кэш и есть все данные — вытеснять нельзя
+            return
+        if len(self.hot) <= self.max_hot and self.bytes <= self.max_bytes:
+            return
+        # Идём от давно неактивных; изменённых, но ещё не сохранённых не вытесняем,
+        # как и занятых обработчиками и только что запрошенного (он последний в LRU)
+        for user_id in list(self.hot)[:-1]:
+            if len(self.hot) <= self.max_hot and self.bytes <= self.max_bytes:
+                break
+            if user_id not in self._dirty and user_id not in self._pins:
+                self.bytes -= self.hot.pop(user_id).size
+                self.evicted += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.hot),
+            "bytes": self.bytes,
+            "dirty": len(self._dirty),
+            "evicted": self.evicted,
+        }
+
+    async def start(self):
+        self.backend.open()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить данные пользователей")
+
+    async def flush(self):
+        """Сохраняет всех изменённых пользователей одной транзакцией."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            # Сериализуем в event loop, чтобы не читать сессии из другого потока
+            items = {
+                uid: json.dumps(self.hot[uid].to_dict(), ensure_ascii=False)
+                for uid in dirty
+                if uid in self.hot
+            }
+            try:
+                await asyncio.to_thread(self.backend.save_many, items)
+            except Exception:
+                # Вернём пометки, чтобы попробовать ещё раз в следующий раз
+                self._dirty |= dirty
+                raise
+            self._evict()
+
+    async def close(self):
+        """Останавливает фоновую запись, сохраняет всё накопленное и закрывает бэкенд."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self.backend.close()
+
+
+def _make_backend():
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteBackend(STORAGE_SQLITE_PATH)
+    return MemoryBackend()
+
+
+store = UserStore(
+    _make_backend(),
+    STORAGE_HOT_USERS,
+    STORAGE_FLUSH_INTERVAL_SECONDS,
+    STORAGE_MEMORY_BUDGET_MB * 1024 * 1024,
+)
+
+
+def get_user(user_id: int) -> Session:
+    """
+    Возвращает сессию пользователя, создаёт по умолчанию при отсутствии.
+    """
+    return store.get(user_id)
+
+
+def pin_user(user_id: int):
+    """
+    Контекстный менеджер: сессия пользователя не выгружается из памяти,
+    пока обработчик с ней работает. Внутри блока get_user() отдаёт тот же объект.
+    """
+    return store.pin(user_id)
+
+
+def save_user(user_id: int, user: Optional[Session] = None):
+    """
+    Помечает настройки пользователя изменёнными — они будут сохранены
+    при ближайшей фоновой записи. Вызывать после любого изменения get_user().
+    """
+    store.mark_dirty(user_id, user)
@@ -0,0 +1,68 @@
+# tests/test_scheduler.py
+# Планировщик генераций: запрос, который может выполняться прямо сейчас,
+# не должен ждать в очереди за запросами к другой, занятой модели.
+#
+# Запуск из корня репозитория:
+#     python -m pytest -q tests
+
+import asyncio
+import unittest
+
+from services.scheduler import GenerationScheduler
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def make(self) -> GenerationScheduler:
+        return GenerationScheduler(
+            max_concurrent=4, max_per_model={"*": 2}, queue_size=10, queue_timeout=2
+        )
+
+    async def test_other_model_is_not_blocked_by_queued_request(self):
+        scheduler = self.make()
+        release = asyncio.Event()
+
+        async def hold(user_id: int, model: str):
+            async with scheduler.slot(user_id, model):
+                await release.wait()
+
+        # Две генерации llama занимают её лимит, третья ждёт в очереди
+        tasks = [asyncio.create_task(hold(uid, "llama")) for uid in (1, 2, 3)]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.in_flight, 2)
+        self.assertEqual(scheduler.queued, 1)
+
+        # Общие слоты и вся квота qwen свободны — запрос другого пользователя идёт сразу
+        async with scheduler.slot(4, "qwen") as waited:
+            self.assertLess(waited, 0.1)
+            self.assertEqual(scheduler.in_flight, 3)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(scheduler.in_flight, 0)
+        self.assertEqual(scheduler.queued, 0)
+
+    async def test_user_requests_keep_their_order(self):
+        scheduler = self.make()
+        order = []
+        release = asyncio.Event()
+
+        async def hold(model: str):
+            async with scheduler.slot(1, model):
+                order.append(model)
+                await release.wait()
+
+        first = asyncio.create_task(hold("llama"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(hold("qwen"))
+        await asyncio.sleep(0)
+        # Одна генерация на пользователя: второй запрос ждёт первый
+        self.assertEqual(order, ["llama"])
+        self.assertEqual(scheduler.queued, 1)
+
+        release.set()
+        await asyncio.gather(first, second)
+        self.assertEqual(order, ["llama", "qwen"])
+
+
+if __name__ == "__main__":
+    unittest.main()
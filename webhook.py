@@ -0,0 +1,186 @@
+# webhook.py
+# Режим webhook: aiohttp-сервер принимает обновления от Telegram, проверяет
+# секретный токен и раздаёт их процессам-воркерам. Пользователь всегда попадает
+# в один и тот же воркер (user_id % WEBHOOK_WORKERS), поэтому кэш пользователей
+# в storage у каждого воркера свой и не расходится с другими.
+# При WEBHOOK_WORKERS = 1 обновления обрабатываются прямо в процессе сервера.
+
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+from typing import List, Optional
+
+from aiohttp import web
+from aiogram import Bot
+
+from config import (
+    TOKEN,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Виды обновлений, в которых есть отправитель
+_UPDATE_KINDS = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "my_chat_member",
+    "chat_member",
+)
+
+
+def update_user_id(update: dict) -> int:
+    """Id пользователя, от которого пришло обновление (0 — если его нет)."""
+    for kind in _UPDATE_KINDS:
+        obj = update.get(kind)
+        if isinstance(obj, dict):
+            sender = obj.get("from")
+            if isinstance(sender, dict) and "id" in sender:
+                return int(sender["id"])
+            chat = obj.get("chat")
+            if isinstance(chat, dict) and "id" in chat:
+                return int(chat["id"])
+    return 0
+
+
+def _check_secret(request: web.Request) -> bool:
+    if not WEBHOOK_SECRET:
+        return True
+    got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    return hmac.compare_digest(got, WEBHOOK_SECRET)
+
+
+# ---------- воркер ----------
+
+def _worker_main(index: int, workers: int, queue):
+    """Точка входа процесса-воркера: читает обновления из очереди и обрабатывает их."""
+    try:
+        asyncio.run(_worker_loop(index, workers, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_loop(index: int, workers: int, queue):
+    from main import create_dispatcher
+
+    bot = Bot(token=TOKEN)
+    dp = create_dispatcher(worker_index=index, workers=workers)
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    logger.info("Воркер %d запущен", index)
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, json.loads(raw)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        await bot.session.close()
+        logger.info("Воркер %d остановлен", index)
+
+
+# ---------- сервер ----------
+
+class WebhookServer:
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.bot = Bot(token=TOKEN)
+        self._queues: List = []
+        self._processes: List[multiprocessing.Process] = []
+        # Для одного воркера — Dispatcher прямо в этом процессе
+        self._dp = None
+        self._tasks = set()
+
+    async def on_startup(self, app: web.Application):
+        if self.workers == 1:
+            from main import create_dispatcher
+
+            self._dp = create_dispatcher()
+            await self._dp.emit_startup(
+                bot=self.bot, dispatcher=self._dp, bots=[self.bot], **self._dp.workflow_data
+            )
+            allowed = self._dp.resolve_used_update_types()
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            for i in range(self.workers):
+                q = ctx.Queue()
+                p = ctx.Process(target=_worker_main, args=(i, self.workers, q), name=f"hubert-worker-{i}")
+                p.start()
+                self._queues.append(q)
+                self._processes.append(p)
+            from handlers.messages import router
+
+            allowed = router.resolve_used_update_types()
+
+        await self.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=allowed,
+        )
+        logger.info(
+            "Webhook слушает %s:%s%s, воркеров: %d",
+            WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, self.workers,
+        )
+
+    async def on_cleanup(self, app: web.Application):
+        if self._dp is not None:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._dp.emit_shutdown(
+                bot=self.bot, dispatcher=self._dp, bots=[self.bot], **self._dp.workflow_data
+            )
+        for q in self._queues:
+            q.put(None)
+        loop = asyncio.get_running_loop()
+        for p in self._processes:
+            await loop.run_in_executor(None, p.join, 30)
+        await self.bot.session.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not _check_secret(request):
+            return web.Response(status=401)
+        raw = await request.read()
+        try:
+            update = json.loads(raw)
+        except ValueError:
+            return web.Response(status=400)
+
+        # Отвечаем Telegram сразу, обработка идёт в фоне
+        if self._dp is not None:
+            task = asyncio.create_task(self._dp.feed_raw_update(self.bot, update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            index = update_user_id(update) % self.workers
+            self._queues[index].put(raw.decode())
+        return web.Response()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+def run(workers: Optional[int] = None):
+    """Запускает webhook-сервер (блокирует до остановки)."""
+    server = WebhookServer(WEBHOOK_WORKERS if workers is None else workers)
+    web.run_app(server.app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)